@@ -0,0 +1,289 @@
+import os
+import time
+import numpy as np
+from six.moves import cPickle
+import matplotlib.pyplot as plt
+import helper
+from tfomics import utils, explain, metrics, sweep, grouped, training, archive
+
+#------------------------------------------------------------------------------------------------
+
+
+class ClassificationSweep():
+    """training sweep of Task 1 and Task 2: every model and activation is trained num_trials
+       times on one dataset, 1st layer filters are saved for Tomtom and the performance
+       is summarized per configuration.
+
+       The task scripts create one at module level (so that spawned sweep workers create
+       their own) and hand module-level wrappers of train, train_group and attach_data
+       to the sweep runner."""
+
+    def __init__(self, task, data_path, input_shape, model_names, activations, num_trials=10,
+                 num_workers=4, pin_cpus=True, early_termination=False, trials_per_group=1,
+                 budget_hours=None, max_restarts=0, figsize=(30,5)):
+        self.task = task
+        self.data_path = data_path
+        self.input_shape = input_shape
+        self.model_names = model_names
+        self.activations = activations
+        self.num_trials = num_trials
+        self.num_workers = num_workers
+        self.pin_cpus = pin_cpus
+        self.early_termination = early_termination
+        self.trials_per_group = trials_per_group
+        self.budget_hours = budget_hours
+        self.max_restarts = max_restarts
+        self.figsize = figsize
+        self.shared_name = task + '_data'
+        self.data = None
+
+        # save path
+        self.results_path = utils.make_directory('../results', task)
+        self.save_path = utils.make_directory(self.results_path, 'conv_filters')
+        self.checkpoints_path = utils.make_directory(self.results_path, 'checkpoints')
+
+        # weights and metadata of all runs in one archive, appended to by every worker
+        self.weight_archive = archive.WeightArchive(os.path.join(self.results_path, 'weights'))
+
+        self.scheduler = sweep.SuccessiveHalving(os.path.join(self.results_path, 'asha'), monitor='val_aupr',
+                                                 min_epoch=4, reduction_factor=3, max_epoch=100)
+
+        # each worker builds a model once and re-initializes it for the next trials
+        self.models = training.ModelCache(self.build_model, helper.compile_model, max_models=20)
+
+
+    def build_model(self, model_name, activation):
+        return helper.load_model(model_name, activation=activation, input_shape=self.input_shape)
+
+
+    def attach_data(self, name):
+        self.shared, self.data = helper.attach_data(name)
+
+    #--------------------------------------------------------------------------------------------
+
+    def train(self, job):
+        x_train, y_train, x_valid, y_valid, x_test, y_test = self.data
+
+        # load compiled model with fresh weights
+        model = self.models.get(job['model_name'], job['activation'], seed=job['trial'])
+        name = job['name']
+        print('model: ' + name)
+
+        # setup callbacks
+        callbacks = helper.get_callbacks(monitor='val_aupr', patience=20,
+                                  decay_patience=5, decay_factor=0.2)
+        if self.early_termination:
+            # trials are ranked against the other trials of their configuration
+            pruner = self.scheduler.callback(job['name'], group=job['model_name']+'_'+job['activation'])
+            callbacks.append(pruner)
+
+        train_data = helper.get_dataset(x_train, y_train, batch_size=100, shuffle=True)
+        valid_data = helper.get_dataset(x_valid, y_valid, batch_size=100)
+
+        # stop at a checkpoint before the end of the time window
+        budget = training.Budget(deadline=job.get('deadline'))
+
+        # checkpoint every epoch; a rerun of an interrupted run resumes from the last one
+        checkpoint = training.Checkpoint(os.path.join(self.checkpoints_path, name), callbacks=callbacks, keep=2,
+                                         budget=budget)
+
+        # stop a diverging run (e.g. exponential overflow); with max_restarts, restart it from
+        # the last good checkpoint with a lower learning rate
+        max_preactivation = 80 if job['activation'] in ['exponential', 'exp'] else None
+        monitor = training.TrainingMonitor((x_train[:100], y_train[:100]), name=name,
+                                           log_path=os.path.join(self.results_path, 'events', name+'.jsonl'),
+                                           max_preactivation=max_preactivation)
+
+        # fit model
+        fit = lambda initial_epoch: model.fit(train_data,
+                                              epochs=100,
+                                              initial_epoch=initial_epoch,
+                                              validation_data=valid_data,
+                                              callbacks=callbacks+[budget, monitor, checkpoint])
+        training.fit_with_restarts(model, fit, checkpoint, monitor, max_restarts=self.max_restarts, lr_factor=0.1)
+        if budget.stopped_epoch is not None:
+            return {'paused_epoch': budget.stopped_epoch}, []
+
+        results, artifacts = self.save_run(model, job, x_test, y_test, model.predict(x_test))
+        checkpoint.clear()
+        if self.early_termination and pruner.pruned_epoch:
+            results['pruned_epoch'] = pruner.pruned_epoch
+        if monitor.restarts:
+            results['restarts'] = monitor.restarts
+        if monitor.event:
+            results['diverged'] = monitor.event['event']
+        return results, artifacts
+
+
+    def train_group(self, job):
+        """train trials_per_group trials of a configuration as one fused model; every trial is
+           saved and recorded in the manifest on its own, tagged with its group as the trials
+           shared a learning-rate schedule (see grouped.get_grouped_callbacks)"""
+
+        x_train, y_train, x_valid, y_valid, x_test, y_test = self.data
+        self.models.clear()
+
+        trials = range(job['group']*self.trials_per_group, (job['group']+1)*self.trials_per_group)
+        build_fn = lambda: self.build_model(job['model_name'], job['activation'])
+        model, copies = grouped.build_grouped_model(build_fn, len(trials), input_shape=(self.input_shape,4))
+        print('model: ' + job['name'])
+
+        # compile model with a loss term per trial and set up per-trial early stopping
+        gates = grouped.compile_grouped_model(model)
+        callbacks = grouped.get_grouped_callbacks(model, copies, gates, monitor='val_aupr', patience=20,
+                                                  decay_patience=5, decay_factor=0.2)
+
+        # one input pipeline feeds every trial
+        train_data = helper.get_dataset(x_train, y_train, batch_size=100, shuffle=True)
+        valid_data = helper.get_dataset(x_valid, y_valid, batch_size=100)
+
+        # fit model
+        # checkpoint every epoch; a rerun of an interrupted group resumes from the last one
+        budget = training.Budget(deadline=job.get('deadline'))
+        checkpoint = training.Checkpoint(os.path.join(self.checkpoints_path, job['name']), callbacks=callbacks, keep=2,
+                                         budget=budget)
+
+        model.fit(grouped.grouped_dataset(train_data, model.output_names),
+                  epochs=100,
+                  initial_epoch=checkpoint.initial_epoch,
+                  validation_data=grouped.grouped_dataset(valid_data, model.output_names),
+                  callbacks=callbacks+[budget, checkpoint])
+        if budget.stopped_epoch is not None:
+            return {'paused_epoch': budget.stopped_epoch}, []
+
+        predictions = model.predict(x_test)
+        if len(copies) == 1:
+            predictions = [predictions]
+
+        manifest = sweep.Manifest(self.results_path)
+        names, artifacts = [], []
+        for trial, copy, trial_predictions in zip(trials, copies, predictions):
+            name = job['model_name']+'_'+job['activation']+'_'+str(trial)
+            trial_job = {'model_name': job['model_name'], 'activation': job['activation'],
+                         'trial': trial, 'name': name, 'group': job['name']}
+            results, paths = self.save_run(copy, trial_job, x_test, y_test, trial_predictions)
+            results['group'] = job['name']
+            manifest.record(trial_job, results, paths)
+            names.append(name)
+            artifacts += paths
+        checkpoint.clear()
+        return {'trials': names}, artifacts
+
+
+    def save_run(self, model, job, x_test, y_test, predictions):
+        """save 1st layer filters of a trained model, score its predictions and archive its
+           weights with the run's settings and scores"""
+        name = job['name']
+
+        # get 1st convolution layer filters
+        fig, W, logo = explain.plot_filers(model, x_test, layer=3, threshold=0.5,
+                                           window=20, num_cols=8, figsize=self.figsize)
+        outfile = os.path.join(self.save_path, name+'.pdf')
+        with sweep.atomic_output(outfile) as tmp_path:
+            fig.savefig(tmp_path, format='pdf', dpi=200, bbox_inches='tight')
+        plt.close()
+
+        # clip filters about motif to reduce false-positive Tomtom matches
+        W_clipped = utils.clip_filters(W, threshold=0.5, pad=3)
+        output_file = os.path.join(self.save_path, name+'.meme')
+        with sweep.atomic_output(output_file) as tmp_path:
+            utils.meme_generate(W_clipped, tmp_path)
+
+        # calculate performance metrics of test predictions
+        mean_vals, std_vals = metrics.calculate_metrics(y_test, predictions, 'binary')
+
+        results = {'roc_mean': float(mean_vals[1]), 'roc_std': float(std_vals[1]),
+                   'pr_mean': float(mean_vals[2]), 'pr_std': float(std_vals[2])}
+
+        # save model; trials trained in a fused model are tagged with their group
+        tags = {'group': job['group']} if 'group' in job else {}
+        self.weight_archive.add(name, model.get_weights(), model_name=job['model_name'], activation=job['activation'],
+                                trial=job['trial'], **tags, **results)
+        return results, [outfile, output_file]
+
+    #--------------------------------------------------------------------------------------------
+
+    def run(self, train_fn, train_group_fn, attach_fn):
+        """run the sweep with the module-level wrappers of train, train_group and attach_data
+           of the calling script, then write the summaries"""
+
+        # load dataset once and share it with the workers
+        self.data = helper.load_data(self.data_path)
+        shared_data = helper.share_data(self.data, self.shared_name)
+
+        # runs already in the manifest are skipped, so an interrupted sweep can be rerun
+        if self.trials_per_group > 1:
+            jobs = sweep.expand_jobs(model_name=self.model_names, activation=self.activations,
+                                     group=range(self.num_trials//self.trials_per_group))
+            for job in jobs:
+                job['name'] = 'group_' + job['name']
+            run_fn = train_group_fn
+        else:
+            jobs = sweep.expand_jobs(model_name=self.model_names, activation=self.activations,
+                                     trial=range(self.num_trials))
+            run_fn = train_fn
+        deadline = time.time() + self.budget_hours*3600 if self.budget_hours else None
+        failed = sweep.run_sweep(run_fn, jobs, self.results_path, num_workers=self.num_workers,
+                                 pin_cpus=self.pin_cpus, initializer=attach_fn, initargs=(self.shared_name,),
+                                 deadline=deadline, order_by='group' if self.trials_per_group > 1 else 'trial',
+                                 group_keys=['model_name', 'activation'])
+        # workers exit without closing their handles, so remove the shared copy outright
+        shared_data.close()
+        shared_data.unlink(self.shared_name)
+        self.weight_archive.consolidate()
+        self.write_summary()
+        return failed
+
+
+    def write_summary(self):
+        records = sweep.Manifest(self.results_path).records()
+
+        # with early termination only the trials that survived every rung are averaged, so
+        # they go to separately labelled files rather than the summaries of all trials
+        suffix = '_asha_survivors' if self.early_termination else ''
+
+        # save results to file
+        file_path = os.path.join(self.results_path, self.task+'_classification_performance'+suffix+'.tsv')
+        with open(file_path, 'w') as f:
+            f.write('%s\t%s\t%s\n'%('model', 'ave roc', 'ave pr'))
+
+            results = {}
+            for model_name in self.model_names:
+                results[model_name] = {}
+                for activation in self.activations:
+                    trial_roc_mean = []
+                    trial_pr_mean = []
+                    for trial in range(self.num_trials):
+                        name = model_name+'_'+activation+'_'+str(trial)
+                        # pruned and restarted runs trained differently and are listed separately
+                        if name in records and records[name]['status'] == 'done':
+                            trial_roc_mean.append(records[name]['results']['roc_mean'])
+                            trial_pr_mean.append(records[name]['results']['pr_mean'])
+
+                    f.write("%s\t%.3f+/-%.3f\t%.3f+/-%.3f\n"%(name,
+                                                              np.mean(trial_roc_mean),
+                                                              np.std(trial_roc_mean),
+                                                              np.mean(trial_pr_mean),
+                                                              np.std(trial_pr_mean)))
+                    results[model_name][activation] = np.array([trial_roc_mean, trial_pr_mean])
+
+        # runs stopped early by successive halving
+        file_path = os.path.join(self.results_path, self.task+'_pruned_runs.tsv')
+        with open(file_path, 'w') as f:
+            f.write('%s\t%s\t%s\n'%('model', 'epoch', self.scheduler.monitor))
+            for name, record in self.scheduler.pruned().items():
+                f.write('%s\t%d\t%.3f\n'%(name, record['epoch'], record['value']))
+
+        # runs restarted with a lower learning rate after diverging
+        file_path = os.path.join(self.results_path, self.task+'_restarted_runs.tsv')
+        with open(file_path, 'w') as f:
+            f.write('%s\t%s\t%s\t%s\n'%('model', 'restarts', 'roc', 'pr'))
+            for name, record in records.items():
+                if record['status'] == 'restarted':
+                    f.write('%s\t%d\t%.3f\t%.3f\n'%(name, record['results']['restarts'],
+                                                     record['results']['roc_mean'], record['results']['pr_mean']))
+
+        # pickle results
+        file_path = os.path.join(self.results_path, self.task+"_performance_results"+suffix+".pickle")
+        with open(file_path, 'wb') as f:
+            cPickle.dump(results, f, protocol=cPickle.HIGHEST_PROTOCOL)
@@ -23,7 +23,7 @@ save_path = utils.make_directory(results_path, 'conv_filters')
 
 # load dataset
 data_path = '../../data/synthetic_dataset.h5'
-data = helper.load_data(data_path)
+data = helper.load_data(data_path, cache_dir='../../data/cache')
 x_train, y_train, x_valid, y_valid, x_test, y_test = data
 
 
@@ -69,11 +69,12 @@ with open(file_path, 'w') as f:
                                                               mode='max',
                                                               verbose=1) 
 
-                history = model.fit(x_train, y_train, 
+                train_data = helper.get_dataset(x_train, y_train, batch_size=100, shuffle=True)
+                valid_data = helper.get_dataset(x_valid, y_valid, batch_size=100)
+
+                history = model.fit(train_data, 
                                     epochs=100,
-                                    batch_size=100, 
-                                    shuffle=True,
-                                    validation_data=(x_valid, y_valid), 
+                                    validation_data=valid_data, 
                                     callbacks=[es_callback, reduce_lr])
 
                 # save model
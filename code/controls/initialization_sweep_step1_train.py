@@ -1,9 +1,9 @@
-import os
+import os, sys, time
 import numpy as np
 import matplotlib.pyplot as plt
 from tensorflow import keras
 import helper
-from tfomics import utils, explain, metrics
+from tfomics import utils, explain, metrics, sweep, training, archive
 
 from model_zoo import cnn_deep
 #------------------------------------------------------------------------------------------------
@@ -14,99 +14,225 @@ num_trials = 10
 model_name = 'cnn-deep'
 sigmas = [0.001, 0.005, 0.01, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.75, 1.0, 2.0, 3, 4, 5]
 
+# parallel runs, each limited to its share of the cpus
+num_workers = 4
+pin_cpus = True
+
+# asynchronous successive halving: stop runs that fall behind the other trials of their
+# configuration at epochs 4, 12 and 36; the summary then averages only the surviving trials
+# and is written to separately labelled files
+early_termination = False
+
+# time window of the sweep in hours (None: no limit); runs that would not finish stop at a
+# checkpoint and resume in the next sweep, and first trials of every configuration run first
+budget_hours = None
+
+# restart diverged runs from their last checkpoint with a 10x lower learning rate, up to
+# this many times; restarted runs are reported apart from the others
+max_restarts = 0
+
 # save path
 results_path = utils.make_directory('../../results', 'initialization_sweep')
-params_path = utils.make_directory(results_path, 'model_params')
 save_path = utils.make_directory(results_path, 'conv_filters')
+checkpoints_path = utils.make_directory(results_path, 'checkpoints')
 
+# weights and metadata of all runs in one archive, appended to by every worker
+weight_archive = archive.WeightArchive(os.path.join(results_path, 'weights'))
 
-#------------------------------------------------------------------------------------------------
+scheduler = sweep.SuccessiveHalving(os.path.join(results_path, 'asha'), monitor='val_auroc',
+                                    min_epoch=4, reduction_factor=3, max_epoch=100)
 
-# load dataset
 data_path = '../../data/synthetic_dataset.h5'
-data = helper.load_data(data_path)
-x_train, y_train, x_valid, y_valid, x_test, y_test = data
-
-
-file_path = os.path.join(results_path, 'performance_initializations.tsv')
-with open(file_path, 'w') as f:
-    f.write('%s\t%s\t%s\n'%('model', 'ave roc', 'ave pr'))
-
-    for activation in activations:
-        for sigma in sigmas:
-            trial_roc_mean = []
-            trial_roc_std = []
-            trial_pr_mean = []
-            trial_pr_std = []
-            for trial in range(num_trials):
-                keras.backend.clear_session()
-                    
-                # load model
-                model = cnn_deep.model(activation, input_shape=200, initialization=keras.initializers.RandomNormal(mean=0.0, stddev=sigma))
+shared_name = 'initialization_sweep_data'
+
+def build_model(activation, sigma):
+    return cnn_deep.model(activation, input_shape=200, initialization=keras.initializers.RandomNormal(mean=0.0, stddev=sigma))
+
+
+def compile_model(model):
+    # set up optimizer and metrics
+    auroc = keras.metrics.AUC(curve='ROC', name='auroc')
+    aupr = keras.metrics.AUC(curve='PR', name='aupr')
+    optimizer = keras.optimizers.Adam(learning_rate=0.001)
+    loss = keras.losses.BinaryCrossentropy(from_logits=False, label_smoothing=0)
+    model.compile(optimizer=optimizer,
+                  loss=loss,
+                  metrics=['accuracy', auroc, aupr])
+
+
+# each worker builds a model once and re-initializes it for the next trials
+models = training.ModelCache(build_model, compile_model, max_models=len(sigmas))
 
+#------------------------------------------------------------------------------------------------
+
+def attach_data(name):
+    global data, shared
+    shared, data = helper.attach_data(name)
+
+
+def train(job):
+    x_train, y_train, x_valid, y_valid, x_test, y_test = data
+
+    # load compiled model with fresh weights
+    model = models.get(job['activation'], job['sigma'], seed=job['trial'])
+
+    name = job['name']
+    print('model: ' + name)
+
+    es_callback = keras.callbacks.EarlyStopping(monitor='val_auroc', #'val_aupr',#
+                                                patience=20,
+                                                verbose=1,
+                                                mode='max',
+                                                restore_best_weights=False)
+    reduce_lr = keras.callbacks.ReduceLROnPlateau(monitor='val_auroc',
+                                                  factor=0.2,
+                                                  patience=5,
+                                                  min_lr=1e-7,
+                                                  mode='max',
+                                                  verbose=1)
+    callbacks = [es_callback, reduce_lr]
+    if early_termination:
+        # trials are ranked against the other trials of their configuration
+        pruner = scheduler.callback(job['name'], group=job['activation']+'_'+str(job['sigma']))
+        callbacks.append(pruner)
+
+    train_data = helper.get_dataset(x_train, y_train, batch_size=100, shuffle=True)
+    valid_data = helper.get_dataset(x_valid, y_valid, batch_size=100)
+
+    # stop at a checkpoint before the end of the time window
+    budget = training.Budget(deadline=job.get('deadline'))
+
+    # checkpoint every epoch; a rerun of an interrupted run resumes from the last one
+    checkpoint = training.Checkpoint(os.path.join(checkpoints_path, name), callbacks=callbacks, keep=2,
+                                     budget=budget)
+
+    # stop a diverging run (e.g. exponential overflow); with max_restarts, restart it from
+    # the last good checkpoint with a lower learning rate
+    max_preactivation = 80 if job['activation'] in ['exponential', 'exp'] else None
+    monitor = training.TrainingMonitor((x_train[:100], y_train[:100]), name=name,
+                                       log_path=os.path.join(results_path, 'events', name+'.jsonl'),
+                                       max_preactivation=max_preactivation)
+
+    fit = lambda initial_epoch: model.fit(train_data,
+                                          epochs=100,
+                                          initial_epoch=initial_epoch,
+                                          validation_data=valid_data,
+                                          callbacks=callbacks+[budget, monitor, checkpoint])
+    training.fit_with_restarts(model, fit, checkpoint, monitor, max_restarts=max_restarts, lr_factor=0.1)
+    if budget.stopped_epoch is not None:
+        return {'paused_epoch': budget.stopped_epoch}, []
+
+    # get 1st convolution layer filters
+    fig, W, logo = explain.plot_filers(model, x_test, layer=3, threshold=0.5,
+                                       window=20, num_cols=8, figsize=(30,5))
+    outfile = os.path.join(save_path, name+'.pdf')
+    with sweep.atomic_output(outfile) as tmp_path:
+        fig.savefig(tmp_path, format='pdf', dpi=200, bbox_inches='tight')
+    plt.close()
+
+    # clip filters about motif to reduce false-positive Tomtom matches
+    W_clipped = utils.clip_filters(W, threshold=0.5, pad=3)
+    output_file = os.path.join(save_path, name+'.meme')
+    with sweep.atomic_output(output_file) as tmp_path:
+        utils.meme_generate(W_clipped, tmp_path)
+
+    # predict test sequences and calculate performance metrics
+    predictions = model.predict(x_test)
+    mean_vals, std_vals = metrics.calculate_metrics(y_test, predictions, 'binary')
+
+    results = {'roc_mean': float(mean_vals[1]), 'roc_std': float(std_vals[1]),
+               'pr_mean': float(mean_vals[2]), 'pr_std': float(std_vals[2])}
+
+    # save model
+    weight_archive.add(name, model.get_weights(), model_name=model_name, activation=job['activation'],
+                       sigma=job['sigma'], trial=job['trial'], **results)
+    if early_termination and pruner.pruned_epoch:
+        results['pruned_epoch'] = pruner.pruned_epoch
+    if monitor.restarts:
+        results['restarts'] = monitor.restarts
+    if monitor.event:
+        results['diverged'] = monitor.event['event']
+    checkpoint.clear()
+    return results, [outfile, output_file]
+
+#------------------------------------------------------------------------------------------------
+
+def write_summary():
+    records = sweep.Manifest(results_path).records()
+
+    # with early termination only the trials that survived every rung are averaged
+    suffix = '_asha_survivors' if early_termination else ''
+
+    file_path = os.path.join(results_path, 'performance_initializations'+suffix+'.tsv')
+    with open(file_path, 'w') as f:
+        f.write('%s\t%s\t%s\n'%('model', 'ave roc', 'ave pr'))
+
+        for activation in activations:
+            for sigma in sigmas:
                 base_name = model_name+'_'+activation+'_'+str(sigma)
-                name = base_name+'_'+str(trial)
-                print('model: ' + name)
-
-                # set up optimizer and metrics
-                auroc = keras.metrics.AUC(curve='ROC', name='auroc')
-                aupr = keras.metrics.AUC(curve='PR', name='aupr')
-                optimizer = keras.optimizers.Adam(learning_rate=0.001)
-                loss = keras.losses.BinaryCrossentropy(from_logits=False, label_smoothing=0)
-                model.compile(optimizer=optimizer,
-                              loss=loss,
-                              metrics=['accuracy', auroc, aupr])
-
-
-                es_callback = keras.callbacks.EarlyStopping(monitor='val_auroc', #'val_aupr',#
-                                                            patience=20, 
-                                                            verbose=1, 
-                                                            mode='max', 
-                                                            restore_best_weights=False)
-                reduce_lr = keras.callbacks.ReduceLROnPlateau(monitor='val_auroc', 
-                                                              factor=0.2,
-                                                              patience=5, 
-                                                              min_lr=1e-7,
-                                                              mode='max',
-                                                              verbose=1) 
-
-                history = model.fit(x_train, y_train, 
-                                    epochs=100,
-                                    batch_size=100, 
-                                    shuffle=True,
-                                    validation_data=(x_valid, y_valid), 
-                                    callbacks=[es_callback, reduce_lr])
-
-                # save model
-                weights_path = os.path.join(params_path, name+'.hdf5')
-                model.save_weights(weights_path)
-
-                results = model.evaluate(x_test, y_test, batch_size=512)      
-                          
-                # get 1st convolution layer filters
-                fig, W, logo = explain.plot_filers(model, x_test, layer=3, threshold=0.5, 
-                                                   window=20, num_cols=8, figsize=(30,5))
-                outfile = os.path.join(save_path, name+'.pdf')
-                fig.savefig(outfile, format='pdf', dpi=200, bbox_inches='tight')
-                plt.close()
-
-                # clip filters about motif to reduce false-positive Tomtom matches 
-                W_clipped = utils.clip_filters(W, threshold=0.5, pad=3)
-                output_file = os.path.join(save_path, name+'.meme')
-                utils.meme_generate(W_clipped, output_file) 
-
-                # predict test sequences and calculate performance metrics
-                predictions = model.predict(x_test)                
-                mean_vals, std_vals = metrics.calculate_metrics(y_test, predictions, 'binary')
-
-                trial_roc_mean.append(mean_vals[1])
-                trial_roc_std.append(std_vals[1])
-                trial_pr_mean.append(mean_vals[2])
-                trial_pr_std.append(std_vals[2])
-
-            f.write("%s\t%.3f+/-%.3f\t%.3f+/-%.3f\n"%(base_name, 
-                                                      np.mean(trial_roc_mean),
-                                                      np.std(trial_roc_mean), 
-                                                      np.mean(trial_pr_mean),
-                                                      np.std(trial_pr_mean)))
+                trial_roc_mean = []
+                trial_pr_mean = []
+                for trial in range(num_trials):
+                    name = base_name+'_'+str(trial)
+                    # pruned and restarted runs trained differently and are listed separately
+                    if name in records and records[name]['status'] == 'done':
+                        trial_roc_mean.append(records[name]['results']['roc_mean'])
+                        trial_pr_mean.append(records[name]['results']['pr_mean'])
+
+                f.write("%s\t%.3f+/-%.3f\t%.3f+/-%.3f\n"%(base_name,
+                                                          np.mean(trial_roc_mean),
+                                                          np.std(trial_roc_mean),
+                                                          np.mean(trial_pr_mean),
+                                                          np.std(trial_pr_mean)))
+
+    # runs stopped early by successive halving
+    file_path = os.path.join(results_path, 'pruned_initializations.tsv')
+    with open(file_path, 'w') as f:
+        f.write('%s\t%s\t%s\n'%('model', 'epoch', scheduler.monitor))
+        for name, record in scheduler.pruned().items():
+            f.write('%s\t%d\t%.3f\n'%(name, record['epoch'], record['value']))
+
+    # runs restarted with a lower learning rate after diverging
+    file_path = os.path.join(results_path, 'restarted_initializations.tsv')
+    with open(file_path, 'w') as f:
+        f.write('%s\t%s\t%s\t%s\n'%('model', 'restarts', 'roc', 'pr'))
+        for name, record in records.items():
+            if record['status'] == 'restarted':
+                f.write('%s\t%d\t%.3f\t%.3f\n'%(name, record['results']['restarts'],
+                                                 record['results']['roc_mean'], record['results']['pr_mean']))
+
+#------------------------------------------------------------------------------------------------
 
+if __name__ == '__main__':
+
+    jobs = sweep.expand_jobs(model_name=[model_name], activation=activations, sigma=sigmas,
+                             trial=range(num_trials))
+    deadline = time.time() + budget_hours*3600 if budget_hours else None
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'queue':
+        # distributed: start this script with 'queue' on every node that shares results_path;
+        # jobs are submitted once and each node trains until the queue is drained
+        data = helper.load_data(data_path, cache_dir='../../data/cache')
+        queue = sweep.JobQueue(os.path.join(results_path, 'queue'), lease_time=1800)
+        queue.put(jobs)
+        failed = queue.drain(train, results_path, deadline=deadline)
+        print(queue.status())
+        # once every job is done, one worker packs the weights of all workers into one file
+        if queue.drained() and queue.run_once('consolidate'):
+            weight_archive.consolidate()
+
+    else:
+        # load dataset once and share it with the workers
+        data = helper.load_data(data_path, cache_dir='../../data/cache')
+        shared_data = helper.share_data(data, shared_name)
+
+        # runs already in the manifest are skipped, so an interrupted sweep can be rerun
+        failed = sweep.run_sweep(train, jobs, results_path, num_workers=num_workers, pin_cpus=pin_cpus,
+                                 initializer=attach_data, initargs=(shared_name,), deadline=deadline,
+                                 order_by='trial', group_keys=['activation', 'sigma'])
+        # workers exit without closing their handles, so remove the shared copy outright
+        shared_data.close()
+        shared_data.unlink(shared_name)
+        weight_archive.consolidate()
+
+    write_summary()
@@ -1,10 +1,8 @@
 import os
-import numpy as np
-from six.moves import cPickle
 import matplotlib.pyplot as plt
 from tensorflow import keras
 import helper
-from tfomics import utils, explain, metrics
+from tfomics import utils, explain, training, archive
 
 #------------------------------------------------------------------------------------------------
 
@@ -16,14 +14,14 @@ activations = ['relu', 'exponential']
 
 # save path
 results_path = utils.make_directory('../../results', 'task1')
-params_path = utils.make_directory(results_path, 'model_params')
+weight_archive = archive.WeightArchive(os.path.join(results_path, 'weights'))
 save_path = utils.make_directory(results_path, 'conv_filters_threshold_sweep')
 
 #------------------------------------------------------------------------------------------------
 
 # load dataset
 data_path = '../../data/synthetic_dataset.h5'
-data = helper.load_data(data_path)
+data = helper.load_data(data_path, cache_dir='../../data/cache')
 x_train, y_train, x_valid, y_valid, x_test, y_test = data
 
 
@@ -35,22 +33,20 @@ for model_name in model_names:
         trial_roc_std = []
         trial_pr_mean = []
         trial_pr_std = []
+        keras.backend.clear_session()
+
+        # build and compile model once, then swap in the weights of each trial
+        model = helper.load_model(model_name, 
+                                        activation=activation, 
+                                        input_shape=200)
+        helper.compile_model(model)
+        weights = training.WeightCache(model, archive=weight_archive)
         for trial in range(num_trials):
-            keras.backend.clear_session()
-            
-            # load model
-            model = helper.load_model(model_name, 
-                                            activation=activation, 
-                                            input_shape=200)
             name = model_name+'_'+activation+'_'+str(trial)
             print('model: ' + name)
 
-            # compile model
-            helper.compile_model(model)
-
-            # save model
-            weights_path = os.path.join(params_path, name+'.hdf5')
-            model.load_weights(weights_path)
+            # load model
+            model = weights.load(name)
                      
             for threshold in thresholds:
 
@@ -1,52 +1,79 @@
 import os, sys
+import hashlib
 import h5py
 import pandas as pd
 import numpy as np
 from sklearn.metrics import roc_curve, auc, precision_recall_curve, accuracy_score, roc_auc_score
+import tensorflow as tf
 from tensorflow import keras
+from tfomics import datasets
 
 
 
-def load_data(file_path, reverse_compliment=False):
+def load_data(file_path, reverse_compliment=False, lazy=False, compact=False, cache_dir=None, select=None):
+    """reverse_compliment: False, True (append reverse-complements in memory) or 
+       'virtual' (expose 2N rows and flip the reverse-complements per batch)
+       lazy: read and convert sequences to (N, L, 4) float32 only when indexed
+       compact: hold sequences as uint8 tokens and expand them per batch
+       cache_dir: memory-map model-ready arrays cached from a previous load (with select,
+       only the selected rows are read and cached unless the whole splits are cached)
+       select: rows to read from every split, as indices, a boolean mask or a predicate on
+       the labels; a dict keyed by 'train'/'valid'/'test' selects per split (splits that
+       are not listed are left empty). Applied before reverse-complements are added."""
+
+    if cache_dir:
+        if compact:
+            raise ValueError('cache_dir stores float32 arrays and cannot be combined with compact')
+        return load_cached(load_data, file_path, cache_dir, reverse_compliment, lazy, select)
 
     # load dataset
     dataset = h5py.File(file_path, 'r')
-    x_train = np.array(dataset['X_train']).astype(np.float32)
-    y_train = np.array(dataset['Y_train']).astype(np.float32)
-    x_valid = np.array(dataset['X_valid']).astype(np.float32)
-    y_valid = np.array(dataset['Y_valid']).astype(np.float32)
-    x_test = np.array(dataset['X_test']).astype(np.float32)
-    y_test = np.array(dataset['Y_test']).astype(np.float32)
-
-    x_train = np.squeeze(x_train)
-    x_valid = np.squeeze(x_valid)
-    x_test = np.squeeze(x_test)
+    x_train, y_train = load_split(dataset['X_train'], dataset['Y_train'], np.float32, lazy, compact, select, 'train')
+    x_valid, y_valid = load_split(dataset['X_valid'], dataset['Y_valid'], np.float32, lazy, compact, select, 'valid')
+    x_test, y_test = load_split(dataset['X_test'], dataset['Y_test'], np.float32, lazy, compact, select, 'test')
 
     if reverse_compliment:
-        x_train_rc = x_train[:,::-1,:][:,:,::-1]
-        x_valid_rc = x_valid[:,::-1,:][:,:,::-1]
-        x_test_rc = x_test[:,::-1,:][:,:,::-1]
-        
-        x_train = np.vstack([x_train, x_train_rc])
-        x_valid = np.vstack([x_valid, x_valid_rc])
-        x_test = np.vstack([x_test, x_test_rc])
-        
-        y_train = np.vstack([y_train, y_train])
-        y_valid = np.vstack([y_valid, y_valid])
-        y_test = np.vstack([y_test, y_test])
-        
-    x_train = x_train.transpose([0,2,1])
-    x_valid = x_valid.transpose([0,2,1])
-    x_test = x_test.transpose([0,2,1])
+        virtual = lazy or compact or (reverse_compliment == 'virtual')
+        x_train, y_train = reverse_complement_data(x_train, y_train, virtual)
+        x_valid, y_valid = reverse_complement_data(x_valid, y_valid, virtual)
+        x_test, y_test = reverse_complement_data(x_test, y_test, virtual)
 
     return x_train, y_train, x_valid, y_valid, x_test, y_test
 
 
 
-def load_synthetic_models(filepath, dataset='test'):
+def load_synthetic_models(filepath, dataset='test', lazy=False, cache_dir=None, select=None):
     # setup paths for file handling
 
     trainmat = h5py.File(filepath, 'r')
+    index = None
+    if select is not None:
+        # predicates are evaluated on the labels of the same split
+        labels = np.array(trainmat['Y_'+dataset]).astype(np.float32)
+        index = select_rows(select, labels, dataset)
+
+    if cache_dir:
+        key = datasets.cache_key(filepath, cache_dir, loader='load_synthetic_models', dataset=dataset)
+        cached = datasets.load_cache(cache_dir, key, ['model'])
+        if cached is not None:
+            return cached[0] if index is None else cached[0][index]
+        if index is not None:
+            # without the whole split cached, only the selected rows are read and cached
+            key = datasets.cache_key(filepath, cache_dir, loader='load_synthetic_models', dataset=dataset,
+                                     select=selection_digest([index]))
+            cached = datasets.load_cache(cache_dir, key, ['model'])
+            if cached is None:
+                datasets.save_cache(cache_dir, key, {'model': load_synthetic_models(filepath, dataset, select=index)})
+                cached = datasets.load_cache(cache_dir, key, ['model'])
+            return cached[0]
+        datasets.save_cache(cache_dir, key, {'model': load_synthetic_models(filepath, dataset)})
+        return datasets.load_cache(cache_dir, key, ['model'])[0]
+
+    model = datasets.LazyArray(trainmat['model_'+dataset], np.float32, squeeze=False)
+    if lazy:
+        return model if index is None else datasets.SubsetArray(model, index)
+    if index is not None:
+        return model[index]
     if dataset == 'train':
         return np.array(trainmat['model_train']).astype(np.float32)
     elif dataset == 'valid':
@@ -55,40 +82,208 @@ def load_synthetic_models(filepath, dataset='test'):
         return np.array(trainmat['model_test']).astype(np.float32)
 
 
-def load_basset_dataset(filepath, reverse_compliment=False):
+def load_basset_dataset(filepath, reverse_compliment=False, lazy=False, compact=False, cache_dir=None, select=None):
+
+    if cache_dir:
+        if compact:
+            raise ValueError('cache_dir stores float32 arrays and cannot be combined with compact')
+        return load_cached(load_basset_dataset, filepath, cache_dir, reverse_compliment, lazy, select)
 
     trainmat = h5py.File(filepath, 'r')
+    x_train, y_train = load_split(trainmat['train_in'], trainmat['train_out'], np.int32, lazy, compact, select, 'train')
+    x_valid, y_valid = load_split(trainmat['valid_in'], trainmat['valid_out'], np.int32, lazy, compact, select, 'valid')
+    x_test, y_test = load_split(trainmat['test_in'], trainmat['test_out'], np.int32, lazy, compact, select, 'test')
 
-    x_train = np.array(trainmat['train_in']).astype(np.float32)
-    y_train = np.array(trainmat['train_out']).astype(np.int32)
-    x_valid = np.array(trainmat['valid_in']).astype(np.float32)
-    y_valid = np.array(trainmat['valid_out']).astype(np.int32)
-    x_test = np.array(trainmat['test_in']).astype(np.float32)
-    y_test = np.array(trainmat['test_out']).astype(np.int32)
+    if reverse_compliment:
+        virtual = lazy or compact or (reverse_compliment == 'virtual')
+        x_train, y_train = reverse_complement_data(x_train, y_train, virtual)
+        x_valid, y_valid = reverse_complement_data(x_valid, y_valid, virtual)
+        x_test, y_test = reverse_complement_data(x_test, y_test, virtual)
 
-    x_train = np.squeeze(x_train)
-    x_valid = np.squeeze(x_valid)
-    x_test = np.squeeze(x_test)
+    return x_train, y_train, x_valid, y_valid, x_test, y_test
 
-    x_train = x_train.transpose([0,2,1])
-    x_valid = x_valid.transpose([0,2,1])
-    x_test = x_test.transpose([0,2,1])
 
 
-    if reverse_compliment:
-        x_train_rc = x_train[:,::-1,:][:,:,::-1]
-        x_valid_rc = x_valid[:,::-1,:][:,:,::-1]
-        x_test_rc = x_test[:,::-1,:][:,:,::-1]
-        
-        x_train = np.vstack([x_train, x_train_rc])
-        x_valid = np.vstack([x_valid, x_valid_rc])
-        x_test = np.vstack([x_test, x_test_rc])
-        
-        y_train = np.vstack([y_train, y_train])
-        y_valid = np.vstack([y_valid, y_valid])
-        y_test = np.vstack([y_test, y_test])
+def load_cached(loader, file_path, cache_dir, reverse_compliment=False, lazy=False, select=None):
+    """memory-map the model-ready splits of a loader from cache_dir, building and caching 
+       them on first use (keyed by the source file hash and the loader options)"""
+
+    # selections and reverse-complements are applied on top of the cached originals
+    names = ['x_train', 'y_train', 'x_valid', 'y_valid', 'x_test', 'y_test']
+    key = datasets.cache_key(file_path, cache_dir, loader=loader.__name__)
+    data = datasets.load_cache(cache_dir, key, names)
+    if data is None and select is not None:
+        # without the whole splits cached, only the selected rows are read and cached
+        data, select = load_cached_selection(loader, file_path, cache_dir, select), None
+    if data is None:
+        datasets.save_cache(cache_dir, key, dict(zip(names, loader(file_path))))
+        data = datasets.load_cache(cache_dir, key, names)
+    data = list(data)
+
+    for i, split in enumerate(['train', 'valid', 'test']):
+        x, y = data[2*i], data[2*i+1]
+        index = select_rows(select, y, split)
+        if index is not None:
+            x, y = x[index], y[index]
+        if reverse_compliment:
+            x, y = reverse_complement_data(x, y, lazy or (reverse_compliment == 'virtual'))
+        data[2*i], data[2*i+1] = x, y
+
+    return tuple(data)
+
+
+def load_cached_selection(loader, file_path, cache_dir, select):
+    """selected rows of a loader's splits, read through lazy views and cached under a key
+       of the resolved row indices"""
+
+    names = ['x_train', 'y_train', 'x_valid', 'y_valid', 'x_test', 'y_test']
+    data = list(loader(file_path, lazy=True))
+    index = [select_rows(select, data[2*i+1], split) for i, split in enumerate(['train', 'valid', 'test'])]
+    key = datasets.cache_key(file_path, cache_dir, loader=loader.__name__, select=selection_digest(index))
+    cached = datasets.load_cache(cache_dir, key, names)
+    if cached is None:
+        arrays = {}
+        for i, split in enumerate(['train', 'valid', 'test']):
+            x, y = data[2*i], data[2*i+1]
+            if index[i] is not None:
+                x, y = x[index[i]], y[index[i]]
+            arrays['x_'+split], arrays['y_'+split] = np.asarray(x), y
+        datasets.save_cache(cache_dir, key, arrays)
+        cached = datasets.load_cache(cache_dir, key, names)
+    return cached
+
+
+
+def share_data(data, name):
+    """copy loaded splits into shared memory once, so that sweep worker processes can 
+       attach them with attach_data(name) instead of each loading their own copy"""
+    names = ['x_train', 'y_train', 'x_valid', 'y_valid', 'x_test', 'y_test']
+    return datasets.SharedDataset.create(name, dict(zip(names, data)))
+
+
+def attach_data(name):
+    """zero-copy views of splits published with share_data; keep the returned handle
+       alive while the arrays are in use and close it when done"""
+    shared = datasets.SharedDataset.attach(name)
+    names = ['x_train', 'y_train', 'x_valid', 'y_valid', 'x_test', 'y_test']
+    return shared, tuple(shared[key] for key in names)
+
+
+
+def load_split(x_dataset, y_dataset, label_type, lazy=False, compact=False, select=None, split=None):
+    """sequences and labels of one split, reading only the selected rows"""
+    y = np.array(y_dataset).astype(label_type)
+    index = select_rows(select, y, split)
+    x = load_sequences(x_dataset, lazy, compact, index)
+    if index is not None:
+        y = y[index]
+    return x, y
+
+
+def select_rows(select, labels, split=None):
+    """resolve a selection (indices, boolean mask or predicate on labels, or a dict of these
+       keyed by split) into row indices; None selects every row"""
+
+    if isinstance(select, dict):
+        select = select.get(split, [])
+    if select is None:
+        return None
+    if callable(select):
+        select = select(labels)
+    index = np.asarray(select)
+    if index.dtype == bool:
+        index = np.where(index)[0]
+    return index.astype(np.int64)
+
+
+def selection_digest(indices):
+    """sha1 of resolved row indices (None for every row), to key cached selections"""
+    sha = hashlib.sha1()
+    for index in indices:
+        sha.update(b'all' if index is None else b'%d:'%(len(index)) + np.ascontiguousarray(index).tobytes())
+    return sha.hexdigest()
+
+
+def load_sequences(dataset, lazy=False, compact=False, index=None):
+    """(N, L, 4) float32 sequences from a one-hot or a compact (uint8/2bit) HDF5 dataset;
+       index reads only those rows (with a single sorted selection)"""
+
+    if datasets.is_compact(dataset):
+        if lazy:
+            x = datasets.CompactArray(dataset)
+            return x if index is None else datasets.SubsetArray(x, index)
+        if index is None:
+            tokens = dataset[()]
+        else:
+            tokens = datasets.LazyArray(dataset, dataset.dtype, squeeze=False)[index]
+        x = datasets.CompactArray(tokens, dataset.attrs['encoding'], 
+                                  dataset.attrs['length'], dataset.attrs['unknown'])
+        return x if compact else x[:]
+
+    if lazy:
+        x = datasets.LazyArray(dataset, np.float32, transpose=True)
+        return x if index is None else datasets.SubsetArray(x, index)
+    if index is None:
+        x = np.squeeze(np.array(dataset).astype(np.float32)).transpose([0,2,1])
+    else:
+        x = datasets.LazyArray(dataset, np.float32, transpose=True)[index]
+    if compact:
+        tokens, unknown = datasets.onehot_to_tokens(x)
+        return datasets.CompactArray(tokens, 'uint8', unknown=unknown)
+    return x
+
+
+
+def reverse_complement_data(x, y, virtual=False):
+    """append reverse-complements of (N, L, 4) sequences; the virtual mode keeps a 
+       single copy and flips sequences when a batch is indexed"""
+
+    if virtual:
+        return datasets.ReverseComplementArray(x), datasets.ReverseComplementArray(y, flip=False)
+
+    x_rc = x[:,::-1,:][:,:,::-1]
+    return np.vstack([x, x_rc]), np.vstack([y, y])
+
+
+
+def get_dataset(x, y=None, batch_size=100, shuffle=False, augment=None, seed=None):
+    """tf.data pipeline over in-memory arrays or array-like views (lazy, compact, virtual
+       reverse-complements or shared memory): indices rather than data are shuffled, each
+       batch is gathered with sorted indices (sequential reads from the underlying storage)
+       in a parallel map, optionally augmented with a numpy function, and prefetched while
+       the model trains on the previous batch. In graph mode, build it after clear_session
+       so it lives in the model's graph."""
+
+    N = len(x)
+    x_shape = (None,) + tuple(x.shape[1:])
+
+    def gather(index):
+        # sorted indices give sequential reads from the underlying storage
+        index = np.sort(index)
+        x_batch = np.asarray(x[index], dtype=np.float32)
+        if augment:
+            x_batch = augment(x_batch).astype(np.float32, copy=False)
+        if y is None:
+            return x_batch
+        return x_batch, np.asarray(y[index], dtype=np.float32)
+
+    def tf_gather(index):
+        if y is None:
+            x_batch = tf.numpy_function(gather, [index], tf.float32)
+            x_batch.set_shape(x_shape)
+            return x_batch
+        x_batch, y_batch = tf.numpy_function(gather, [index], [tf.float32, tf.float32])
+        x_batch.set_shape(x_shape)
+        y_batch.set_shape((None,) + tuple(np.shape(y)[1:]))
+        return x_batch, y_batch
+
+    dataset = tf.data.Dataset.range(N)
+    if shuffle:
+        dataset = dataset.shuffle(N, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(tf_gather, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
-    return x_train, y_train, x_valid, y_valid, x_test, y_test
     
 
 def load_model(model_name, activation='relu', input_shape=200):
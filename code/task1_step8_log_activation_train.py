@@ -76,11 +76,12 @@ with open(file_path, 'w') as f:
                                                               mode='max',
                                                               verbose=1) 
 
-                history = model.fit(x_train, y_train, 
+                train_data = helper.get_dataset(x_train, y_train, batch_size=100, shuffle=True)
+                valid_data = helper.get_dataset(x_valid, y_valid, batch_size=100)
+
+                history = model.fit(train_data, 
                                     epochs=100,
-                                    batch_size=100, 
-                                    shuffle=True,
-                                    validation_data=(x_valid, y_valid), 
+                                    validation_data=valid_data, 
                                     callbacks=[es_callback, reduce_lr])
 
                 # save model
@@ -54,12 +54,13 @@ with open(os.path.join(results_path, 'task3_classification_performance.tsv'), 'w
                 callbacks = helper.get_callbacks(monitor='val_auroc', patience=20, 
                                           decay_patience=5, decay_factor=0.2)
 
+                train_data = helper.get_dataset(x_train, y_train, batch_size=100, shuffle=True)
+                valid_data = helper.get_dataset(x_valid, y_valid, batch_size=100)
+
                 # fit model
-                history = model.fit(x_train, y_train, 
+                history = model.fit(train_data, 
                                     epochs=100,
-                                    batch_size=100, 
-                                    shuffle=True,
-                                    validation_data=(x_valid, y_valid), 
+                                    validation_data=valid_data, 
                                     callbacks=callbacks)
 
                 # save model
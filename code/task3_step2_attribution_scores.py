@@ -3,7 +3,7 @@ import numpy as np
 from six.moves import cPickle
 from tensorflow import keras
 import helper
-from tfomics import utils, explain
+from tfomics import utils, explain, training
 
 #------------------------------------------------------------------------
 
@@ -20,38 +20,39 @@ save_path = utils.make_directory(results_path, 'scores')
 
 # load data
 data_path = '../data/synthetic_code_dataset.h5'
-data = helper.load_data(data_path)
-x_train, y_train, x_valid, y_valid, x_test, y_test = data
+# only the first 500 positive test sequences (and their ground truth) are read
+def positives(y):
+    return np.where(y[:,0] == 1)[0][:500]
+
+data = helper.load_data(data_path, cache_dir='../data/cache', select={'test': positives})
+x_train, y_train, x_valid, y_valid, X, y_test = data
 
 # load ground truth values
-test_model = helper.load_synthetic_models(data_path, dataset='test')
-true_index = np.where(y_test[:,0] == 1)[0]
-X = x_test[true_index][:500]
-X_model = test_model[true_index][:500]
+X_model = helper.load_synthetic_models(data_path, dataset='test', cache_dir='../data/cache', select=positives)
 
 #------------------------------------------------------------------------
 
 for model_name in model_names:
     for activation in activations:
         
+        keras.backend.clear_session()
+
+        # build and compile model once, then swap in the weights of each trial
+        model = helper.load_model(model_name, activation=activation)
+        helper.compile_model(model)
+        names = [model_name+'_'+activation+'_'+str(trial) for trial in range(num_trials)]
+        weights = training.WeightCache(model)
+        weights.preload([os.path.join(params_path, name+'.hdf5') for name in names])
+
         saliency_scores = []
         mut_scores = []
         integrated_scores = []
         shap_scores = []
-        for trial in range(num_trials):
-            keras.backend.clear_session()
-            
-            # load model
-            model = helper.load_model(model_name, activation=activation)
-            name = model_name+'_'+activation+'_'+str(trial)
+        for name in names:
             print('model: ' + name)
 
-            # compile model
-            helper.compile_model(model)
-
             # load model
-            weights_path = os.path.join(params_path, name+'.hdf5')
-            model.load_weights(weights_path)
+            model = weights.load(os.path.join(params_path, name+'.hdf5'))
 
             # interpretability performance with saliency maps
             print('saliency maps')
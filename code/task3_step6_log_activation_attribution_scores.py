@@ -21,14 +21,15 @@ save_path = utils.make_directory(results_path, 'scores')
 
 # load data
 data_path = '../data/synthetic_code_dataset.h5'
-data = helper.load_data(data_path)
-x_train, y_train, x_valid, y_valid, x_test, y_test = data
+# only the first 500 positive test sequences (and their ground truth) are read
+def positives(y):
+    return np.where(y[:,0] == 1)[0][:500]
+
+data = helper.load_data(data_path, cache_dir='../data/cache', select={'test': positives})
+x_train, y_train, x_valid, y_valid, X, y_test = data
 
 # load ground truth values
-test_model = helper.load_synthetic_models(data_path, dataset='test')
-true_index = np.where(y_test[:,0] == 1)[0]
-X = x_test[true_index][:500]
-X_model = test_model[true_index][:500]
+X_model = helper.load_synthetic_models(data_path, dataset='test', cache_dir='../data/cache', select=positives)
 
 #------------------------------------------------------------------------
 
@@ -17,8 +17,12 @@ save_path = utils.make_directory(results_path, 'conv_filters')
 
 # load dataset
 data_path = '../data/er.h5'
-data = helper.load_basset_dataset(data_path, reverse_compliment=True)
+data = helper.load_basset_dataset(data_path, reverse_compliment='virtual')
 x_train, y_train, x_valid, y_valid, x_test, y_test = data
+y_test = np.array(y_test)
+
+# the filter analysis indexes the test sequences row by row, which is slow on the virtual view
+x_test = np.asarray(x_test)
 
 #------------------------------------------------------------------------------------------------
 
@@ -41,13 +45,15 @@ with open(file_path, 'w') as f:
         callbacks = helper.get_callbacks(monitor='val_auroc', patience=20, 
                                   decay_patience=5, decay_factor=0.2)
 
+        train_data = helper.get_dataset(x_train, y_train, batch_size=100, shuffle=True)
+        valid_data = helper.get_dataset(x_valid, y_valid, batch_size=100)
+        test_data = helper.get_dataset(x_test, batch_size=100)
+
         # fit model
-        history = model.fit(x_train, y_train, 
+        history = model.fit(train_data, 
                             epochs=100,
-                            batch_size=100, 
-                            shuffle=True,
                             class_weight=None, 
-                            validation_data=(x_valid, y_valid), 
+                            validation_data=valid_data, 
                             callbacks=callbacks)
 
         # save model
@@ -56,7 +62,7 @@ with open(file_path, 'w') as f:
 
         # get filter representations
         intermediate = keras.Model(inputs=model.inputs, outputs=model.layers[3].output)
-        fmap = intermediate.predict(x_test)
+        fmap = intermediate.predict(test_data)
         W = explain.activation_pwm(fmap, x_test, threshold=0.5, window=20)
                   
         # clip filters about motif to reduce false-positive Tomtom matches 
@@ -65,7 +71,7 @@ with open(file_path, 'w') as f:
         utils.meme_generate(W_clipped, output_file) 
 
         # write results to file
-        predictions = model.predict(x_test)                
+        predictions = model.predict(test_data)                
         mean_vals, std_vals = metrics.calculate_metrics(y_test, predictions, 'binary')
         f.write("%s\t%.3f+/-%.3f\t%.3f+/-%.3f\n"%(name, 
                                                   mean_vals[1],
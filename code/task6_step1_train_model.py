@@ -17,8 +17,9 @@ params_path = utils.make_directory(results_path, 'model_params')
 #------------------------------------------------------------------------
 
 file_path = '../data/IRF1_400_h3k27ac.h5' 
-data = helper.load_data(file_path, reverse_compliment=True)
+data = helper.load_data(file_path, reverse_compliment='virtual')
 x_train, y_train, x_valid, y_valid, x_test, y_test = data
+y_test = np.array(y_test)
 
 #------------------------------------------------------------------------
 
@@ -43,12 +44,14 @@ with open(file_path, 'w') as f:
             callbacks = helper.get_callbacks(monitor='val_auroc', patience=20, 
                                       decay_patience=5, decay_factor=0.2)
 
+            train_data = helper.get_dataset(x_train, y_train, batch_size=100, shuffle=True)
+            valid_data = helper.get_dataset(x_valid, y_valid, batch_size=100)
+            test_data = helper.get_dataset(x_test, batch_size=100)
+
             # train model
-            history = model.fit(x_train, y_train, 
+            history = model.fit(train_data, 
                                 epochs=100,
-                                batch_size=100, 
-                                shuffle=True,
-                                validation_data=(x_valid, y_valid), 
+                                validation_data=valid_data, 
                                 callbacks=callbacks)
 
             # save model
@@ -56,7 +59,7 @@ with open(file_path, 'w') as f:
             model.save_weights(weights_path)
 
             # predict test sequences and calculate performance metrics
-            predictions = model.predict(x_test)                
+            predictions = model.predict(test_data)                
             mean_vals, std_vals = metrics.calculate_metrics(y_test, predictions, 'binary')
 
             # print results to file
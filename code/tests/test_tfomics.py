@@ -0,0 +1,291 @@
+"""tests of the data loading, sweep, checkpoint, weight archive and mutagenesis utilities;
+   run from code/ with python -m pytest tests"""
+
+import os
+import h5py
+import numpy as np
+import pytest
+from tensorflow import keras
+import helper
+from tfomics import archive, explain, sweep, training
+
+
+
+def write_dataset(file_path, sizes=(40, 10, 20), length=50, num_labels=3, seed=0):
+    """random one-hot sequences (N, 4, L) and labels in the layout of the generate_data
+       notebooks"""
+    rng = np.random.RandomState(seed)
+    with h5py.File(file_path, 'w') as f:
+        for split, num in zip(['train', 'valid', 'test'], sizes):
+            tokens = rng.randint(4, size=(num, length))
+            f.create_dataset('X_'+split, data=np.eye(4, dtype=np.float32)[tokens].transpose([0,2,1]))
+            f.create_dataset('Y_'+split, data=(rng.rand(num, num_labels) > 0.5).astype(np.float32))
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    file_path = str(tmp_path/'dataset.h5')
+    write_dataset(file_path)
+    return file_path
+
+
+def assert_same_data(data, expected):
+    assert len(data) == len(expected)
+    for actual, values in zip(data, expected):
+        np.testing.assert_array_equal(np.asarray(actual), values)
+
+#------------------------------------------------------------------------------------------------
+# Data loading
+#------------------------------------------------------------------------------------------------
+
+@pytest.mark.parametrize('options', [{'lazy': True}, {'compact': True}, {'cache_dir': True},
+                                     {'cache_dir': True, 'lazy': True}])
+@pytest.mark.parametrize('reverse_compliment', [False, True])
+def test_load_data_matches_eager(dataset, tmp_path, options, reverse_compliment):
+    expected = helper.load_data(dataset, reverse_compliment=reverse_compliment)
+    if 'cache_dir' in options:
+        options = dict(options, cache_dir=str(tmp_path/'cache'))
+
+    # the second load reads the cache written by the first
+    for _ in range(2):
+        data = helper.load_data(dataset, reverse_compliment=reverse_compliment, **options)
+        assert_same_data(data, expected)
+
+
+def test_load_data_virtual_reverse_complement(dataset):
+    expected = helper.load_data(dataset, reverse_compliment=True)
+    data = helper.load_data(dataset, reverse_compliment='virtual')
+    assert_same_data(data, expected)
+
+
+@pytest.mark.parametrize('options', [{}, {'lazy': True}, {'compact': True}, {'cache_dir': True}])
+def test_load_data_select(dataset, tmp_path, options):
+    x_train, y_train, x_valid, y_valid, x_test, y_test = helper.load_data(dataset)
+    select = lambda labels: labels[:,0] == 1
+    expected = []
+    for x, y in [(x_train, y_train), (x_valid, y_valid), (x_test, y_test)]:
+        expected += [x[y[:,0] == 1], y[y[:,0] == 1]]
+
+    if 'cache_dir' in options:
+        options = {'cache_dir': str(tmp_path/'cache')}
+    for _ in range(2):
+        data = helper.load_data(dataset, select=select, **options)
+        assert_same_data(data, expected)
+
+#------------------------------------------------------------------------------------------------
+# Sweeps
+#------------------------------------------------------------------------------------------------
+
+def test_manifest_resume(tmp_path):
+    results_dir = str(tmp_path/'results')
+    os.makedirs(results_dir)
+    jobs = sweep.expand_jobs(model_name=['cnn'], trial=range(4))
+    calls, interrupted = [], [True]
+
+    def run_fn(job):
+        calls.append(job['trial'])
+        if interrupted[0] and job['trial'] == 1:
+            raise RuntimeError('interrupted')
+        if interrupted[0] and job['trial'] == 2:
+            return {'paused_epoch': 3}, []
+        artifact = os.path.join(results_dir, job['name']+'.txt')
+        with open(artifact, 'w') as f:
+            f.write('done')
+        return {'trial': job['trial']}, [artifact]
+
+    failed = sweep.run_sweep(run_fn, jobs, results_dir)
+    assert list(failed) == [jobs[1]['name']]
+    assert sorted(sweep.Manifest(results_dir).records()) == sorted([jobs[0]['name'], jobs[3]['name']])
+
+    # the failed and the paused run are run again, the others are skipped
+    calls.clear()
+    interrupted[0] = False
+    failed = sweep.run_sweep(run_fn, jobs, results_dir)
+    assert failed == {} and sorted(calls) == [1, 2]
+    records = sweep.Manifest(results_dir).records()
+    assert all(records[job['name']]['status'] == 'done' for job in jobs)
+
+    # a run whose artifacts are gone is not done
+    os.remove(os.path.join(results_dir, jobs[0]['name']+'.txt'))
+    assert not sweep.Manifest(results_dir).done(jobs[0]['name'])
+
+
+def test_successive_halving_ranks_within_group(tmp_path):
+    scheduler = sweep.SuccessiveHalving(str(tmp_path/'asha'), min_epoch=4, reduction_factor=3, max_epoch=100)
+    assert scheduler.rungs == [4, 12, 36]
+
+    # the first min_reports runs of a group continue
+    for trial, value in enumerate([0.5, 0.6, 0.7, 0.8]):
+        assert scheduler.report('b_%d'%(trial), 4, value, group='b')
+
+    # a worse group is ranked against its own runs only
+    for trial, value in enumerate([0.1, 0.2, 0.3]):
+        assert scheduler.report('a_%d'%(trial), 4, value, group='a')
+    assert scheduler.report('a_3', 4, 0.4, group='a')
+    assert not scheduler.report('a_4', 4, 0.05, group='a')
+    assert not scheduler.report('b_4', 4, 0.55, group='b')
+
+    # with 6 reports in a group, the top 2 continue
+    assert scheduler.report('b_5', 4, 0.75, group='b')
+    assert not scheduler.report('b_6', 4, 0.7, group='b')
+    assert not scheduler.report('a_5', 4, float('nan'), group='a')
+
+
+def test_successive_halving_callback_prunes(tmp_path):
+    scheduler = sweep.SuccessiveHalving(str(tmp_path/'asha'), monitor='val_aupr', min_epoch=2,
+                                        reduction_factor=2, max_epoch=8, min_reports=1)
+    scheduler.report('best', 2, 0.9, group='cnn')
+
+    model = small_model()
+    pruner = scheduler.callback('worse', group='cnn')
+    pruner.set_model(model)
+    pruner.on_epoch_end(0, {'val_aupr': 0.1})
+    assert pruner.pruned_epoch is None
+    pruner.on_epoch_end(1, {'val_aupr': 0.1})
+    assert pruner.pruned_epoch == 2 and model.stop_training
+    assert scheduler.pruned()['worse']['group'] == 'cnn'
+
+#------------------------------------------------------------------------------------------------
+# Checkpoints
+#------------------------------------------------------------------------------------------------
+
+def small_model():
+    inputs = keras.layers.Input(shape=(8,))
+    nn = keras.layers.Dense(16)(inputs)
+    nn = keras.layers.BatchNormalization()(nn)
+    nn = keras.layers.Activation('relu')(nn)
+    outputs = keras.layers.Dense(1, activation='sigmoid')(nn)
+    model = keras.Model(inputs=inputs, outputs=outputs)
+    model.compile(optimizer=keras.optimizers.Adam(learning_rate=0.01), loss='binary_crossentropy')
+    return model
+
+
+def small_data(num=64, seed=0):
+    rng = np.random.RandomState(seed)
+    x = rng.normal(size=(num, 8)).astype(np.float32)
+    y = (x[:,:1] > 0).astype(np.float32)
+    return x, y
+
+
+class StateProbe(keras.callbacks.Callback):
+    """the weights, optimizer variables and learning rate when training begins"""
+
+    def on_train_begin(self, logs=None):
+        self.weights = self.model.get_weights()
+        self.optimizer = keras.backend.batch_get_value(training.optimizer_variables(self.model.optimizer))
+        self.lr = float(keras.backend.get_value(self.model.optimizer.lr))
+
+
+def test_checkpoint_resume(tmp_path):
+    x, y = small_data()
+    path = str(tmp_path/'checkpoint')
+
+    model = small_model()
+    reduce_lr = keras.callbacks.ReduceLROnPlateau(monitor='loss', factor=0.5, patience=1)
+    checkpoint = training.Checkpoint(path, callbacks=[reduce_lr], keep=2)
+    model.fit(x, y, epochs=3, batch_size=16, callbacks=[reduce_lr, checkpoint], verbose=0)
+    saved = checkpoint.state
+    assert len(checkpoint.checkpoints()) == 2
+
+    # a new process resumes with the weights, optimizer, learning rate and callback state
+    model = small_model()
+    reduce_lr = keras.callbacks.ReduceLROnPlateau(monitor='loss', factor=0.5, patience=1)
+    checkpoint = training.Checkpoint(path, callbacks=[reduce_lr], keep=2)
+    assert checkpoint.initial_epoch == 3
+    probe = StateProbe()
+    model.fit(x, y, epochs=4, initial_epoch=checkpoint.initial_epoch, batch_size=16,
+              callbacks=[reduce_lr, checkpoint, probe], verbose=0)
+    assert_same_data(probe.weights, saved['weights'])
+    assert_same_data(probe.optimizer, saved['optimizer'])
+    assert probe.lr == pytest.approx(saved['lr'])
+    assert reduce_lr.best <= saved['callbacks'][0]['best']
+
+
+def test_checkpoint_of_budget_stop_resumes(tmp_path):
+    x, y = small_data()
+    model = small_model()
+    budget = training.Budget(max_seconds=1e-6, warmup=0)
+    checkpoint = training.Checkpoint(str(tmp_path/'checkpoint'), budget=budget)
+    model.fit(x, y, epochs=5, batch_size=16, callbacks=[budget, checkpoint], verbose=0)
+
+    assert budget.stopped_epoch == 0
+    assert not checkpoint.state['stop_training'] and checkpoint.initial_epoch == 1
+    assert 'budget_stop' not in checkpoint.state['logs']
+
+
+def test_model_cache_reinitializes(tmp_path):
+    x, y = small_data()
+    models = training.ModelCache(lambda name: small_model())
+    model = models.get('a', seed=0)
+    initial = model.get_weights()
+    model.fit(x, y, epochs=2, batch_size=16, verbose=0)
+
+    # every weight, BatchNormalization moving statistics included, and the optimizer are reset
+    model = models.get('a', seed=0)
+    assert_same_data(model.get_weights(), initial)
+    optimizer = keras.backend.batch_get_value(training.optimizer_variables(model.optimizer))
+    assert not any(np.any(value) for value in optimizer)
+
+    # other keys draw other weights for the same seed
+    other = models.get('b', seed=0)
+    assert not np.array_equal(other.get_weights()[0], initial[0])
+
+#------------------------------------------------------------------------------------------------
+# Weight archive
+#------------------------------------------------------------------------------------------------
+
+def test_weight_archive_round_trip(tmp_path):
+    path = str(tmp_path/'weights')
+    rng = np.random.RandomState(0)
+    weights = {name: [rng.normal(size=(3, 4)).astype(np.float32), np.float32(rng.normal())]
+               for name in ['cnn_relu_0', 'cnn_relu_1', 'cnn_exp_0']}
+
+    weight_archive = archive.WeightArchive(path)
+    for name, values in weights.items():
+        weight_archive.add(name, values, activation=name.split('_')[1], trial=int(name[-1]))
+
+    # a reader sees every run
+    reader = archive.WeightArchive(path)
+    assert sorted(reader.names()) == sorted(weights)
+    assert sorted(reader.find(activation='relu')) == ['cnn_relu_0', 'cnn_relu_1']
+    assert reader.metadata('cnn_exp_0') == {'activation': 'exp', 'trial': 0}
+    for name, values in weights.items():
+        assert_same_data(reader.get(name), values)
+
+    # a run added again wins, also for readers that already read the index
+    weights['cnn_relu_0'] = [np.zeros((3, 4), dtype=np.float32), np.float32(1)]
+    archive.WeightArchive(path).add('cnn_relu_0', weights['cnn_relu_0'], activation='relu', trial=0)
+    assert_same_data(reader.get('cnn_relu_0'), weights['cnn_relu_0'])
+
+    # consolidated into one file and one index
+    weight_archive.consolidate()
+    assert os.listdir(os.path.join(path, 'shards')) == []
+    reader = archive.WeightArchive(path)
+    assert len(reader) == 3
+    for name, values in weights.items():
+        assert_same_data(reader.get(name), values)
+
+#------------------------------------------------------------------------------------------------
+# Mutagenesis
+#------------------------------------------------------------------------------------------------
+
+def test_incremental_mutagenesis_matches_full():
+    # wide convolutions over long sequences, where the windows pay off
+    inputs = keras.layers.Input(shape=(1000, 4))
+    nn = keras.layers.Conv1D(64, 19, padding='same')(inputs)
+    nn = keras.layers.BatchNormalization()(nn)
+    nn = keras.layers.Activation('relu')(nn)
+    nn = keras.layers.Conv1D(64, 9, padding='same')(nn)
+    nn = keras.layers.Activation('relu')(nn)
+    nn = keras.layers.MaxPooling1D(50)(nn)
+    nn = keras.layers.Flatten()(nn)
+    nn = keras.layers.Dense(2)(nn)
+    outputs = keras.layers.Activation('sigmoid')(nn)
+    model = keras.Model(inputs=inputs, outputs=outputs)
+    assert explain.incremental_engine(model, -2) is not None
+
+    X = np.eye(4, dtype=np.float32)[np.random.RandomState(0).randint(4, size=(2, 1000))]
+    full = explain.mutagenesis(model, X, class_index=1)
+    incremental = explain.mutagenesis(model, X, class_index=1, incremental=True)
+    np.testing.assert_allclose(incremental, full, atol=1e-5)
+    assert np.all(full[X == 1] == 0)
@@ -0,0 +1,145 @@
+import os
+import glob
+import json
+import time
+import socket
+import h5py
+import numpy as np
+
+
+
+class WeightArchive():
+    """the trained weights of many runs in one directory instead of one file per run. The
+       weights of a run are a group of chunked datasets in an HDF5 file, and every run is
+       listed with its metadata (model, activation, trial, sigma, metrics, ...) in an
+       append-only index, so runs can be found by metadata and loaded one at a time.
+
+       Concurrent workers each append to their own shard file and list their runs in their
+       own index next to it, as appends to a shared file may interleave on NFS; the indexes
+       are merged on reading. consolidate() (with no writers left) packs all shards into
+       archive.h5 and one index.jsonl, which are easy to copy between nodes. When a run is
+       added again, the latest wins."""
+
+    def __init__(self, path, compression='gzip'):
+        self.path = path
+        self.compression = compression
+        self.index_path = os.path.join(path, 'index.jsonl')
+        self.shard = None
+        self.entries = {}
+        self.offsets = {}
+        os.makedirs(os.path.join(path, 'shards'), exist_ok=True)
+
+
+    def add(self, name, weights, **metadata):
+        """append the weights (a list of arrays, as model.get_weights()) of run name"""
+
+        # one shard and one index per writing process, so no file has two writers
+        if self.shard is None:
+            self.shard = os.path.join('shards', '%s-%d.h5'%(socket.gethostname(), os.getpid()))
+        with h5py.File(os.path.join(self.path, self.shard), 'a') as f:
+            write_weights(f, name, weights, metadata, self.compression)
+
+        # the run is listed once its weights are on disk
+        entry = {'name': name, 'file': self.shard, 'added': time.time(), 'metadata': metadata}
+        with open(os.path.join(self.path, self.shard[:-len('.h5')]+'.jsonl'), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+
+    def read_index(self):
+        """read the lines appended since the last call to the consolidated index and to
+           the index of every writer"""
+        index_paths = [self.index_path] + sorted(glob.glob(os.path.join(self.path, 'shards', '*.jsonl')))
+        for index_path in index_paths:
+            offset = self.offsets.get(index_path, 0)
+            try:
+                with open(index_path, 'rb') as f:
+                    f.seek(offset)
+                    chunk = f.read()
+            except FileNotFoundError:
+                continue
+            # a line being appended right now is read next time
+            end = chunk.rfind(b'\n') + 1
+            for line in chunk[:end].decode().splitlines():
+                if line.strip():
+                    entry = json.loads(line)
+                    latest = self.entries.get(entry['name'])
+                    if latest is None or entry.get('added', 0) >= latest.get('added', 0):
+                        self.entries[entry['name']] = entry
+            self.offsets[index_path] = offset + end
+        return self.entries
+
+
+    def names(self):
+        return list(self.read_index())
+
+    def __len__(self):
+        return len(self.read_index())
+
+    def __contains__(self, name):
+        return name in self.read_index()
+
+
+    def metadata(self, name):
+        return self.read_index()[name]['metadata']
+
+
+    def find(self, **criteria):
+        """names of the runs whose metadata has the given values, e.g.
+           find(model_name='cnn-deep', activation='exponential')"""
+        return [name for name, entry in self.read_index().items()
+                if all(entry['metadata'].get(key) == value for key, value in criteria.items())]
+
+
+    def get(self, name):
+        """the weights of run name as a list of arrays, for model.set_weights"""
+        entry = self.read_index()[name]
+        with h5py.File(os.path.join(self.path, entry['file']), 'r') as f:
+            group = f[name]
+            return [group['%04d'%(i)][()] for i in range(len(group))]
+
+
+    def load_weights(self, model, name):
+        model.set_weights(self.get(name))
+        return model
+
+
+    def consolidate(self):
+        """copy the latest weights of every run into archive.h5, rewrite the index and
+           remove the shards; only safe while nothing is added to the archive"""
+
+        entries = self.read_index()
+        archive_file = 'archive.h5'
+        with h5py.File(os.path.join(self.path, archive_file), 'a') as f:
+            for name, entry in entries.items():
+                if entry['file'] == archive_file:
+                    continue
+                with h5py.File(os.path.join(self.path, entry['file']), 'r') as shard:
+                    if name in f:
+                        del f[name]
+                    shard.copy(shard[name], f, name=name)
+                entry['file'] = archive_file
+
+        tmp_path = self.index_path + '.tmp%d'%(os.getpid())
+        with open(tmp_path, 'w') as f:
+            for entry in entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_path, self.index_path)
+        self.offsets = {self.index_path: os.path.getsize(self.index_path)}
+
+        shards_path = os.path.join(self.path, 'shards')
+        for file_name in os.listdir(shards_path):
+            os.remove(os.path.join(shards_path, file_name))
+        self.shard = None
+
+
+
+def write_weights(f, name, weights, metadata, compression=None):
+    if name in f:
+        del f[name]
+    group = f.create_group(name)
+    for i, weight in enumerate(weights):
+        weight = np.asarray(weight)
+        chunks = True if weight.ndim else None
+        group.create_dataset('%04d'%(i), data=weight, chunks=chunks,
+                             compression=compression if weight.ndim else None)
+    group.attrs['metadata'] = json.dumps(metadata)
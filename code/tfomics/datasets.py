@@ -0,0 +1,554 @@
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import contextlib
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import h5py
+
+
+
+def open_source(dataset, mmap=True):
+    """memory-map a contiguous, uncompressed HDF5 dataset; otherwise return the h5py dataset"""
+
+    if mmap and isinstance(dataset, h5py.Dataset):
+        if (dataset.chunks is None) and (dataset.compression is None) and (dataset.size > 0):
+            offset = dataset.id.get_offset()
+            if offset is not None:
+                return np.memmap(dataset.file.filename, mode='r', dtype=dataset.dtype,
+                                 shape=dataset.shape, offset=offset)
+    return dataset
+
+
+
+class ArrayView():
+    """base class for array-like views whose rows are only materialized when indexed"""
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        x = self[:]
+        if dtype is not None:
+            x = x.astype(dtype, copy=False)
+        return x
+
+
+    def __getitem__(self, index):
+
+        # only the batch axis is handled by the view, the rest is applied to the batch
+        if isinstance(index, tuple):
+            x = self[index[0]]
+            if np.ndim(index[0]) == 0 and not isinstance(index[0], slice):
+                return x[index[1:]]
+            return x[(slice(None),) + index[1:]]
+
+        N = len(self)
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += N
+            if (index < 0) | (index >= N):
+                raise IndexError('index %d is out of bounds for size %d'%(index, N))
+            return self.read_slice(index, index+1)[0]
+
+        if isinstance(index, slice):
+            start, stop, step = index.indices(N)
+            if step == 1:
+                return self.read_slice(start, max(start, stop))
+            index = np.arange(start, stop, step)
+
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.where(index)[0]
+        index = np.where(index < 0, index + N, index).astype(np.int64)
+        if len(index) and ((index.min() < 0) | (index.max() >= N)):
+            raise IndexError('index is out of bounds for size %d'%(N))
+        x = self.take(index.ravel())
+        return x.reshape(index.shape + x.shape[1:])
+
+
+    def read_slice(self, start, stop):
+        return self.take(np.arange(start, stop))
+
+    def take(self, index):
+        raise NotImplementedError
+
+
+
+class LazyArray(ArrayView):
+    """array-like view of a stored dataset: rows are only read, cast, squeezed
+       and transposed when they are indexed"""
+
+    def __init__(self, dataset, dtype=np.float32, squeeze=True, transpose=False, mmap=True):
+
+        self.source = open_source(dataset, mmap)
+        self.dtype = np.dtype(dtype)
+        self.transpose = transpose
+
+        # singleton sample axes are dropped (never the first, batch axis)
+        shape = tuple(self.source.shape[1:])
+        self.squeeze_axes = ()
+        if squeeze:
+            self.squeeze_axes = tuple(i+1 for i, s in enumerate(shape) if s == 1)
+            shape = tuple(s for s in shape if s != 1)
+        if transpose:
+            shape = shape[::-1]
+        self.shape = tuple([self.source.shape[0]]) + shape
+
+
+    def read_slice(self, start, stop):
+        return self.convert(self.source[start:stop])
+
+
+    def take(self, index):
+        """read an arbitrary set of rows with a single sorted, duplicate-free selection"""
+
+        if len(index) == 0:
+            return np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+
+        rows, inverse = np.unique(index, return_inverse=True)
+        start, stop = rows[0], rows[-1]+1
+        if stop - start == len(rows):
+            x = self.source[start:stop]
+        elif isinstance(self.source, h5py.Dataset) and (stop - start) < 2*len(rows):
+            # dense selections are cheaper to read as one hyperslab
+            x = self.source[start:stop][rows - start]
+        else:
+            x = self.source[rows]
+        return self.convert(x)[inverse]
+
+
+    def convert(self, x):
+        """cast a raw batch to the model-ready dtype and layout"""
+
+        x = np.asarray(x).astype(self.dtype, copy=False)
+        if self.squeeze_axes:
+            x = np.squeeze(x, axis=self.squeeze_axes)
+        if self.transpose:
+            x = x.transpose([0] + list(range(x.ndim-1, 0, -1)))
+        return np.ascontiguousarray(x)
+
+
+
+class ReverseComplementArray(ArrayView):
+    """virtual 2N view of one-hot sequences (N, L, A): row i+N is the reverse-complement
+       of row i and is flipped on the fly when indexed. With flip=False the rows are
+       simply repeated, which is used for the matching labels."""
+
+    def __init__(self, base, flip=True):
+        self.base = base
+        self.flip = flip
+        self.dtype = base.dtype
+        self.shape = tuple([2*len(base)]) + tuple(base.shape[1:])
+
+
+    def read_slice(self, start, stop):
+        N = len(self.base)
+        if stop <= N:
+            return np.asarray(self.base[start:stop])
+        return self.take(np.arange(start, stop))
+
+
+    def take(self, index):
+        N = len(self.base)
+        x = np.array(self.base[index % N])
+        if self.flip:
+            rc = index >= N
+            x[rc] = x[rc][:, ::-1, ::-1]
+        return x
+
+
+
+class SubsetArray(ArrayView):
+    """view of selected rows of another array or view"""
+
+    def __init__(self, base, index):
+        self.base = base
+        self.index = np.asarray(index, dtype=np.int64)
+        self.dtype = base.dtype
+        self.shape = tuple([len(self.index)]) + tuple(base.shape[1:])
+
+    def take(self, index):
+        return np.asarray(self.base[self.index[index]])
+
+
+
+def random_reverse_complement(x, p=0.5):
+    """augmentation that reverse-complements a random subset of a batch (N, L, A)"""
+    x = np.array(x)
+    index = np.random.rand(len(x)) < p
+    x[index] = x[index][:, ::-1, ::-1]
+    return x
+
+
+
+#-------------------------------------------------------------------------------------------------
+# Compact one-hot storage
+#-------------------------------------------------------------------------------------------------
+
+# tokens 0-3 are A, C, G, T; token 4 is an unknown base (N)
+ALPHABET = 'ACGT'
+UNKNOWN = 4
+
+
+def onehot_lut(unknown=0.0, dtype=np.float32):
+    """lookup table that maps a token to its one-hot row"""
+    lut = np.zeros((5, 4), dtype=dtype)
+    lut[:4] = np.eye(4)
+    lut[UNKNOWN] = unknown
+    return lut
+
+
+def onehot_to_tokens(x):
+    """convert one-hot sequences (N, L, 4) to uint8 tokens (N, L) and the value of the 
+       unknown (non one-hot) rows"""
+
+    x = np.asarray(x)
+    tokens = np.argmax(x, axis=-1).astype(np.uint8)
+    onehot = (np.max(x, axis=-1) == 1) & (np.sum(x, axis=-1) == 1)
+    tokens[~onehot] = UNKNOWN
+
+    # unknown bases must be encoded by a constant row, e.g. all 0 or all 0.25
+    unknown = 0.0
+    if not np.all(onehot):
+        rows = x[~onehot]
+        values = np.unique(rows)
+        if (len(values) > 1) | np.any(rows != rows[:, :1]):
+            raise ValueError('sequences are not one-hot and cannot be stored as tokens')
+        unknown = float(values[0])
+    return tokens, unknown
+
+
+def pack_tokens(tokens):
+    """pack uint8 tokens (N, L) into 2 bits per base (N, ceil(L/4))"""
+
+    tokens = np.asarray(tokens, dtype=np.uint8)
+    if np.any(tokens >= UNKNOWN):
+        raise ValueError('2bit encoding cannot represent unknown bases, use uint8')
+    N, L = tokens.shape
+    pad = -L % 4
+    if pad:
+        tokens = np.concatenate([tokens, np.zeros((N, pad), dtype=np.uint8)], axis=1)
+    tokens = tokens.reshape(N, -1, 4)
+    return tokens[:,:,0] | (tokens[:,:,1] << 2) | (tokens[:,:,2] << 4) | (tokens[:,:,3] << 6)
+
+
+def unpack_tokens(packed, length):
+    """unpack 2-bit packed bases (N, ceil(L/4)) into uint8 tokens (N, L)"""
+
+    packed = np.asarray(packed, dtype=np.uint8)
+    shifts = np.array([0, 2, 4, 6], dtype=np.uint8)
+    tokens = (packed[:,:,np.newaxis] >> shifts) & 3
+    return tokens.reshape(len(packed), -1)[:, :length]
+
+
+def expand_tokens(tokens, lut=None):
+    """build float32 one-hot sequences (N, L, 4) from uint8 tokens (N, L)"""
+    if lut is None:
+        lut = onehot_lut()
+    return lut[tokens]
+
+
+
+class CompactArray(LazyArray):
+    """array-like view of sequences stored as uint8 tokens or 2-bit packed bases; 
+       one-hot batches (N, L, 4) are only built when indexed"""
+
+    def __init__(self, dataset, encoding=None, length=None, unknown=None, dtype=np.float32, mmap=True):
+
+        attrs = getattr(dataset, 'attrs', {})
+        self.encoding = encoding if encoding else attrs.get('encoding', 'uint8')
+        self.length = int(length if length else attrs.get('length', dataset.shape[1]))
+        unknown = unknown if unknown is not None else attrs.get('unknown', 0.0)
+        self.lut = onehot_lut(unknown, dtype)
+
+        LazyArray.__init__(self, dataset, dtype, squeeze=False, transpose=False, mmap=mmap)
+        self.shape = (dataset.shape[0], self.length, 4)
+
+
+    def convert(self, x):
+        tokens = np.asarray(x)
+        if self.encoding == '2bit':
+            tokens = unpack_tokens(tokens, self.length)
+        return self.lut[tokens]
+
+
+    def tokens(self):
+        """in-memory copy of the uint8 tokens (N, L)"""
+        tokens = np.asarray(self.source[:])
+        if self.encoding == '2bit':
+            tokens = unpack_tokens(tokens, self.length)
+        return tokens
+
+
+
+def is_compact(dataset):
+    return 'encoding' in getattr(dataset, 'attrs', {})
+
+
+def convert_to_compact(file_path, output_path, encoding='uint8', batch_size=10000):
+    """convert a one-hot HDF5 dataset (X_train/train_in layout) into uint8 or 2bit tokens;
+       label and ground-truth datasets are copied as they are"""
+
+    if encoding not in ['uint8', '2bit']:
+        raise ValueError('unknown encoding: %s'%(encoding))
+
+    with h5py.File(file_path, 'r') as src, h5py.File(output_path, 'w') as dst:
+        for key in src.keys():
+            if not (key.startswith('X_') or key.endswith('_in')):
+                src.copy(key, dst)
+                continue
+
+            x = LazyArray(src[key], np.float32, transpose=True)
+            N, L, A = x.shape
+            width = L if encoding == 'uint8' else int(np.ceil(L/4))
+
+            # contiguous storage so the compact file can be memory-mapped
+            out = dst.create_dataset(key, shape=(N, width), dtype=np.uint8)
+            unknown = None
+            for start in range(0, N, batch_size):
+                tokens, value = onehot_to_tokens(x[start:start+batch_size])
+                if np.any(tokens == UNKNOWN):
+                    if (unknown is not None) and (unknown != value):
+                        raise ValueError('%s encodes unknown bases inconsistently'%(key))
+                    unknown = value
+                if encoding == '2bit':
+                    tokens = pack_tokens(tokens)
+                out[start:start+batch_size] = tokens
+
+            out.attrs['encoding'] = encoding
+            out.attrs['length'] = L
+            out.attrs['alphabet'] = ALPHABET
+            out.attrs['unknown'] = unknown if unknown is not None else 0.0
+
+
+
+#-------------------------------------------------------------------------------------------------
+# Preprocessed dataset cache
+#-------------------------------------------------------------------------------------------------
+
+CACHE_VERSION = 1
+
+
+def file_hash(file_path, cache_dir=None, block_size=2**24):
+    """sha1 of a file's content; memoized in cache_dir by path, size and mtime so 
+       unchanged files are not re-read"""
+
+    stat = os.stat(file_path)
+    memo_path = None
+    if cache_dir:
+        stamp = '%s|%d|%d'%(os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        memo_path = os.path.join(cache_dir, 'hashes', hashlib.sha1(stamp.encode()).hexdigest())
+        if os.path.isfile(memo_path):
+            with open(memo_path) as f:
+                return f.read().strip()
+
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    if memo_path:
+        os.makedirs(os.path.dirname(memo_path), exist_ok=True)
+        atomic_write(memo_path, digest)
+    return digest
+
+
+def cache_key(file_path, cache_dir=None, **options):
+    """key of a preprocessed dataset: source content hash plus the loader options"""
+    options['version'] = CACHE_VERSION
+    options['source'] = file_hash(file_path, cache_dir)
+    return hashlib.sha1(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+def load_cache(cache_dir, key, names, mmap_mode='r'):
+    """memory-map cached arrays, or return None if the entry does not exist"""
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        return None
+    return [np.load(os.path.join(path, name+'.npy'), mmap_mode=mmap_mode) for name in names]
+
+
+def save_cache(cache_dir, key, arrays):
+    """write a dict of arrays as .npy files; the entry appears atomically, so concurrent
+       writers of the same key are safe"""
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key)
+    tmp_path = tempfile.mkdtemp(prefix=key+'.', dir=cache_dir)
+    for name, x in arrays.items():
+        np.save(os.path.join(tmp_path, name+'.npy'), np.ascontiguousarray(x))
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process finished the same entry first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+def atomic_write(file_path, text):
+    """write a small text file so that readers never see it half-written"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.')
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, file_path)
+
+
+
+#-------------------------------------------------------------------------------------------------
+# Shared-memory datasets for multi-process sweeps
+#-------------------------------------------------------------------------------------------------
+
+class SharedDataset():
+    """named arrays held once in POSIX shared memory. The creating process copies the 
+       arrays in; worker processes attach zero-copy, read-only numpy views by name. 
+       Each handle holds a reference and the memory is unlinked when the last one closes."""
+
+    def __init__(self, name, meta, data, layout, owner=False):
+        self.name = name
+        self.meta = meta
+        self.data = data
+        self.layout = layout
+        self.owner = owner
+        self.closed = False
+
+
+    @classmethod
+    def create(cls, name, arrays, alignment=64):
+        """copy a dict of arrays into new shared memory blocks called name and name_meta"""
+
+        layout = {}
+        offset = 0
+        for key, x in arrays.items():
+            x = np.asarray(x)
+            offset = int(np.ceil(offset/alignment)*alignment)
+            layout[key] = {'shape': list(x.shape), 'dtype': x.dtype.str, 'offset': offset}
+            offset += x.nbytes
+        header = json.dumps(layout).encode()
+
+        with shared_lock(name):
+            data = shared_memory.SharedMemory(name=name, create=True, size=max(offset, 1))
+            meta = shared_memory.SharedMemory(name=name+'_meta', create=True, size=8+len(header))
+            untrack(data)
+            untrack(meta)
+            meta.buf[8:8+len(header)] = header
+            meta.buf[:8] = (1).to_bytes(8, 'little')
+
+        shared = cls(name, meta, data, layout, owner=True)
+        for key, x in arrays.items():
+            shared[key][...] = np.asarray(x)
+        return shared
+
+
+    @classmethod
+    def attach(cls, name):
+        """attach to shared arrays created by another process"""
+
+        with shared_lock(name):
+            meta = shared_memory.SharedMemory(name=name+'_meta')
+            data = shared_memory.SharedMemory(name=name)
+            untrack(meta)
+            untrack(data)
+            count = int.from_bytes(bytes(meta.buf[:8]), 'little')
+            meta.buf[:8] = (count+1).to_bytes(8, 'little')
+
+        header = bytes(meta.buf[8:]).rstrip(b'\x00')
+        return cls(name, meta, data, json.loads(header.decode()))
+
+
+    def __getitem__(self, key):
+        info = self.layout[key]
+        x = np.ndarray(tuple(info['shape']), dtype=np.dtype(info['dtype']), 
+                       buffer=self.data.buf, offset=info['offset'])
+        if not self.owner:
+            x.flags.writeable = False
+        return x
+
+    def keys(self):
+        return list(self.layout.keys())
+
+    def refcount(self):
+        return int.from_bytes(bytes(self.meta.buf[:8]), 'little')
+
+
+    def close(self):
+        """drop this handle's reference; the last handle unlinks the shared memory"""
+
+        if self.closed:
+            return
+        self.closed = True
+        with shared_lock(self.name):
+            count = int.from_bytes(bytes(self.meta.buf[:8]), 'little') - 1
+            self.meta.buf[:8] = (max(count, 0)).to_bytes(8, 'little')
+            if count <= 0:
+                unlink_block(self.data)
+                unlink_block(self.meta)
+        for shm in [self.data, self.meta]:
+            try:
+                shm.close()
+            except BufferError:
+                # views handed out are still alive; the mapping goes away with them
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    @staticmethod
+    def unlink(name):
+        """remove the shared memory of a crashed run regardless of its reference count"""
+        for block in [name, name+'_meta']:
+            try:
+                shm = shared_memory.SharedMemory(name=block)
+                shm.close()
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+
+def lock_path(name):
+    return os.path.join(tempfile.gettempdir(), 'tfomics_shm_'+name+'.lock')
+
+
+@contextlib.contextmanager
+def shared_lock(name):
+    """inter-process lock that guards the reference count of a shared dataset"""
+    with open(lock_path(name), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def untrack(shm):
+    """stop the multiprocessing resource tracker from unlinking a block when this process 
+       exits; lifetime is managed by the reference count instead"""
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+
+def unlink_block(shm):
+    # SharedMemory.unlink also unregisters the block, so register it back first
+    resource_tracker.register(shm._name, 'shared_memory')
+    shm.unlink()
@@ -0,0 +1,334 @@
+import os
+import gzip
+import numpy as np
+import h5py
+from tfomics import datasets
+
+
+
+# byte -> token lookup table; anything other than ACGT (e.g. N) is an unknown base
+BASE_LUT = np.full(256, datasets.UNKNOWN, dtype=np.uint8)
+for i, base in enumerate(datasets.ALPHABET):
+    BASE_LUT[ord(base)] = i
+    BASE_LUT[ord(base.lower())] = i
+
+
+def encode_tokens(seqs, length=None):
+    """convert a list of byte strings into uint8 tokens (N, L) with one table lookup;
+       sequences are center-cropped or N-padded to length"""
+
+    if length is None:
+        length = len(seqs[0])
+    seqs = [fit_length(seq, length) for seq in seqs]
+    buffer = np.frombuffer(b''.join(seqs), dtype=np.uint8)
+    return BASE_LUT[buffer].reshape(len(seqs), length)
+
+
+def one_hot(seqs, length=None, unknown=0.0):
+    """float32 one-hot sequences (N, L, 4) from a list of strings or byte strings"""
+    seqs = [seq.encode() if isinstance(seq, str) else seq for seq in seqs]
+    return datasets.expand_tokens(encode_tokens(seqs, length), datasets.onehot_lut(unknown))
+
+
+def fit_length(seq, length):
+    if len(seq) == length:
+        return seq
+    if len(seq) > length:
+        start = (len(seq) - length)//2
+        return seq[start:start+length]
+    left = (length - len(seq))//2
+    return b'N'*left + seq + b'N'*(length - len(seq) - left)
+
+
+
+#-------------------------------------------------------------------------------------------------
+# Streaming readers
+#-------------------------------------------------------------------------------------------------
+
+def open_text(file_path):
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, 'rb')
+    return open(file_path, 'rb')
+
+
+def read_fasta(file_path, chunk_size=10000):
+    """stream a (optionally gzipped) FASTA file as chunks of (names, sequences)"""
+
+    names, seqs = [], []
+    name, lines = None, []
+    with open_text(file_path) as f:
+        for line in f:
+            line = line.rstrip()
+            if line.startswith(b'>'):
+                if name is not None:
+                    names.append(name)
+                    seqs.append(b''.join(lines))
+                    if len(seqs) == chunk_size:
+                        yield names, seqs
+                        names, seqs = [], []
+                fields = line[1:].split()
+                name = fields[0].decode() if fields else ''
+                lines = []
+            elif line:
+                lines.append(line)
+    if name is not None:
+        names.append(name)
+        seqs.append(b''.join(lines))
+    if seqs:
+        yield names, seqs
+
+
+def read_bed(file_path, chunk_size=10000):
+    """stream a (optionally gzipped) BED file as chunks of split lines"""
+
+    chunk = []
+    with open_text(file_path) as f:
+        for line in f:
+            if line.startswith((b'#', b'track', b'browser')) or not line.strip():
+                continue
+            chunk.append(line.rstrip(b'\r\n').decode().split('\t'))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+
+class FastaReference():
+    """random access to a plain-text reference FASTA through a samtools-style .fai index,
+       which is built on first use; only the requested bases are read"""
+
+    def __init__(self, file_path):
+        if file_path.endswith('.gz'):
+            raise ValueError('reference FASTA must be uncompressed for random access')
+        self.file_path = file_path
+        index_path = file_path + '.fai'
+        if not os.path.isfile(index_path):
+            build_fasta_index(file_path, index_path)
+
+        self.index = {}
+        with open(index_path) as f:
+            for line in f:
+                name, length, offset, linebases, linewidth = line.split('\t')[:5]
+                self.index[name] = (int(length), int(offset), int(linebases), int(linewidth))
+        self.file = open(file_path, 'rb')
+
+
+    def fetch(self, chrom, start, end):
+        """bases [start, end) of chrom as bytes; positions off the chromosome are N"""
+
+        length, offset, linebases, linewidth = self.index[chrom]
+        left = max(0, min(end, 0) - start)
+        right = max(0, end - max(start, length))
+        start, end = max(start, 0), min(end, length)
+        seq = b''
+        if end > start:
+            first = offset + (start//linebases)*linewidth + start%linebases
+            last = offset + ((end-1)//linebases)*linewidth + (end-1)%linebases
+            self.file.seek(first)
+            seq = self.file.read(last - first + 1).replace(b'\n', b'').replace(b'\r', b'')
+        return b'N'*left + seq + b'N'*right
+
+    def close(self):
+        self.file.close()
+
+
+
+def build_fasta_index(file_path, index_path):
+    """scan a FASTA file once and write a .fai index (name, length, offset, bases and
+       bytes per line)"""
+
+    records = []
+    with open(file_path, 'rb') as f:
+        position = 0
+        record = None
+        for line in f:
+            if line.startswith(b'>'):
+                if record:
+                    records.append(record)
+                name = line[1:].split()[0].decode()
+                record = [name, 0, position + len(line), 0, 0]
+            elif record is not None and line.strip():
+                if record[3] == 0:
+                    record[3] = len(line.rstrip(b'\r\n'))
+                    record[4] = len(line)
+                record[1] += len(line.rstrip(b'\r\n'))
+            position += len(line)
+        if record:
+            records.append(record)
+
+    with open(index_path, 'w') as f:
+        for record in records:
+            f.write('%s\t%d\t%d\t%d\t%d\n'%tuple(record))
+
+
+
+#-------------------------------------------------------------------------------------------------
+# Sharded HDF5 writer
+#-------------------------------------------------------------------------------------------------
+
+class ShardWriter():
+    """append encoded sequences to train/valid/test splits in HDF5 shards with the layout
+       helper.load_data expects (X_*: (N, 4, L) float32 one-hot, or compact tokens, and Y_*);
+       a new shard is started once a shard holds shard_size sequences"""
+
+    def __init__(self, output_prefix, length, num_labels=1, shard_size=100000, encoding='onehot'):
+
+        if encoding not in ['onehot', 'uint8', '2bit']:
+            raise ValueError('unknown encoding: %s'%(encoding))
+        self.output_prefix = output_prefix
+        self.length = length
+        self.num_labels = num_labels
+        self.shard_size = shard_size
+        self.encoding = encoding
+        self.paths = []
+        self.file = None
+
+
+    def open_shard(self):
+        path = '%s_%04d.h5'%(self.output_prefix, len(self.paths))
+        self.file = h5py.File(path, 'w')
+        self.paths.append(path)
+        self.count = 0
+
+        L = self.length
+        for split in ['train', 'valid', 'test']:
+            if self.encoding == 'onehot':
+                x = self.file.create_dataset('X_'+split, shape=(0, 4, L), maxshape=(None, 4, L),
+                                             chunks=(min(256, self.shard_size), 4, L), dtype=np.float32)
+            else:
+                width = L if self.encoding == 'uint8' else int(np.ceil(L/4))
+                x = self.file.create_dataset('X_'+split, shape=(0, width), maxshape=(None, width),
+                                             chunks=(min(4096, self.shard_size), width), dtype=np.uint8)
+                x.attrs['encoding'] = self.encoding
+                x.attrs['length'] = L
+                x.attrs['alphabet'] = datasets.ALPHABET
+                x.attrs['unknown'] = 0.0
+            self.file.create_dataset('Y_'+split, shape=(0, self.num_labels),
+                                     maxshape=(None, self.num_labels), dtype=np.float32)
+
+
+    def write(self, split, tokens, labels):
+        """append uint8 tokens (N, L) and labels (N, num_labels) to a split; a chunk that
+           does not fit in the current shard is split at the shard boundary"""
+
+        while len(tokens):
+            if self.file is None or self.count >= self.shard_size:
+                self.close_shard()
+                self.open_shard()
+            size = self.shard_size - self.count
+            self.append(split, tokens[:size], labels[:size])
+            tokens, labels = tokens[size:], labels[size:]
+
+
+    def append(self, split, tokens, labels):
+        if self.encoding == 'onehot':
+            x = datasets.expand_tokens(tokens).transpose([0,2,1])
+        elif self.encoding == '2bit':
+            x = datasets.pack_tokens(tokens)
+        else:
+            x = tokens
+
+        for key, values in [('X_'+split, x), ('Y_'+split, labels)]:
+            dataset = self.file[key]
+            start = dataset.shape[0]
+            dataset.resize(start + len(values), axis=0)
+            dataset[start:] = values
+        self.count += len(tokens)
+
+
+    def close_shard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        self.close_shard()
+        return self.paths
+
+
+
+def assign_splits(num, valid_fraction, test_fraction, rng):
+    draw = rng.random(num)
+    split = np.full(num, 'train', dtype=object)
+    split[draw < valid_fraction + test_fraction] = 'valid'
+    split[draw < test_fraction] = 'test'
+    return split
+
+
+def write_splits(writer, split, tokens, labels):
+    for name in ['train', 'valid', 'test']:
+        index = np.where(split == name)[0]
+        writer.write(name, tokens[index], labels[index])
+
+
+
+def fasta_to_hdf5(fasta_path, output_prefix, length=None, label_fn=None, num_labels=1,
+                  valid_fraction=0.1, test_fraction=0.1, shard_size=100000, chunk_size=10000,
+                  encoding='onehot', seed=None):
+    """stream a FASTA file into sharded HDF5 files; label_fn maps a record name to its
+       labels (all ones if not given). Returns the shard paths."""
+
+    rng = np.random.default_rng(seed)
+    writer = None
+    for names, seqs in read_fasta(fasta_path, chunk_size):
+        if writer is None:
+            length = length if length else len(seqs[0])
+            writer = ShardWriter(output_prefix, length, num_labels, shard_size, encoding)
+
+        tokens = encode_tokens(seqs, length)
+        if label_fn:
+            labels = np.array([label_fn(name) for name in names], dtype=np.float32)
+        else:
+            labels = np.ones((len(seqs), num_labels), dtype=np.float32)
+        split = assign_splits(len(seqs), valid_fraction, test_fraction, rng)
+        write_splits(writer, split, tokens, labels.reshape(len(seqs), num_labels))
+
+    return writer.close() if writer else []
+
+
+
+def bed_to_hdf5(bed_path, reference_path, output_prefix, length=None, label_columns=None,
+                valid_chroms=(), test_chroms=(), valid_fraction=0.1, test_fraction=0.1,
+                shard_size=100000, chunk_size=10000, encoding='onehot', seed=None):
+    """stream BED regions, fetch their sequences from a reference FASTA and write sharded
+       HDF5 files. Regions are resized to length about their center (they must all have
+       the same width otherwise). Labels come from label_columns (all ones if not given).
+       Splits are held-out chromosomes if valid_chroms/test_chroms are given, random
+       fractions otherwise. Returns the shard paths."""
+
+    rng = np.random.default_rng(seed)
+    reference = FastaReference(reference_path)
+    num_labels = len(label_columns) if label_columns else 1
+    writer = None
+    for regions in read_bed(bed_path, chunk_size):
+        chrom = np.array([region[0] for region in regions])
+        start = np.array([int(region[1]) for region in regions])
+        end = np.array([int(region[2]) for region in regions])
+        if length:
+            start = (start + end)//2 - length//2
+            end = start + length
+
+        if writer is None:
+            writer = ShardWriter(output_prefix, int(end[0] - start[0]), num_labels, shard_size, encoding)
+        if np.any(end - start != writer.length):
+            raise ValueError('regions have different widths, set length to resize them')
+
+        seqs = [reference.fetch(c, s, e) for c, s, e in zip(chrom, start, end)]
+        tokens = encode_tokens(seqs, writer.length)
+        if label_columns:
+            labels = np.array([[float(region[i]) for i in label_columns] for region in regions], dtype=np.float32)
+        else:
+            labels = np.ones((len(regions), 1), dtype=np.float32)
+
+        if len(valid_chroms) or len(test_chroms):
+            split = np.full(len(regions), 'train', dtype=object)
+            split[np.isin(chrom, list(valid_chroms))] = 'valid'
+            split[np.isin(chrom, list(test_chroms))] = 'test'
+        else:
+            split = assign_splits(len(regions), valid_fraction, test_fraction, rng)
+        write_splits(writer, split, tokens, labels)
+
+    reference.close()
+    return writer.close() if writer else []
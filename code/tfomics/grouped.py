@@ -0,0 +1,141 @@
+import numpy as np
+from tensorflow import keras
+from tensorflow.keras import backend as K
+
+
+
+def build_grouped_model(build_fn, num_copies, input_shape=(200,4)):
+    """K independent copies of a network side by side in one model that share its input.
+       build_fn() returns a fresh keras.Model, so each copy gets its own initialization.
+       Outputs are named trial_0 ... trial_K-1; returns the fused model and the copies,
+       whose weights can be saved one by one and loaded into a standalone network."""
+
+    inputs = keras.layers.Input(shape=input_shape)
+    copies, outputs = [], []
+    for k in range(num_copies):
+        copy = build_fn()
+        copies.append(copy)
+        outputs.append(keras.layers.Activation('linear', name='trial_%d'%(k))(copy(inputs)))
+    return keras.Model(inputs=inputs, outputs=outputs), copies
+
+
+
+def compile_grouped_model(model, learning_rate=0.001):
+    """compile as helper.compile_model, with a loss term and metrics per copy. Each loss
+       is scaled by a gate variable (returned), which GroupedEarlyStopping sets to 0 once
+       its copy has stopped, so that copy gets no more gradients. Adam's moments still move
+       it for a while; GroupedEarlyStopping puts its stopped weights back at the end."""
+
+    losses, metrics, gates = {}, {}, []
+    for name in model.output_names:
+        gate = K.variable(1.0, name=name+'_gate')
+        gates.append(gate)
+        losses[name] = gated_loss(keras.losses.BinaryCrossentropy(from_logits=False, label_smoothing=0.0), gate)
+        metrics[name] = ['accuracy',
+                         keras.metrics.AUC(curve='ROC', name='auroc'),
+                         keras.metrics.AUC(curve='PR', name='aupr')]
+
+    optimizer = keras.optimizers.Adam(learning_rate=learning_rate)
+    model.compile(optimizer=optimizer, loss=losses, metrics=metrics)
+    return gates
+
+
+def gated_loss(loss_fn, gate):
+    def loss(y_true, y_pred):
+        return gate*loss_fn(y_true, y_pred)
+    return loss
+
+
+
+def grouped_dataset(dataset, output_names):
+    """repeat the labels of a (x, y) dataset for every output of a grouped model"""
+    return dataset.map(lambda x, y: (x, {name: y for name in output_names}))
+
+
+
+def get_grouped_callbacks(model, copies, gates, monitor='val_auroc', patience=20, decay_patience=5,
+                          decay_factor=0.2):
+    """the callbacks of helper.get_callbacks for a grouped model: early stopping per copy,
+       and one learning-rate decay (the optimizer is shared) on the mean of the monitored
+       metric over the copies still training. The copies therefore follow the learning-rate
+       schedule of the group rather than their own plateaus, which is the main difference
+       from training them one at a time; a gate on a copy's loss cannot scale its step, as
+       Adam's updates do not depend on the scale of the gradient."""
+
+    early_stopping = GroupedEarlyStopping(model.output_names, copies, gates, monitor=monitor,
+                                          patience=patience)
+    reduce_lr = keras.callbacks.ReduceLROnPlateau(monitor=early_stopping.mean_monitor,
+                                                  factor=decay_factor,
+                                                  patience=decay_patience,
+                                                  min_lr=1e-7,
+                                                  mode='max',
+                                                  verbose=1)
+    return [early_stopping, reduce_lr]
+
+
+
+class GroupedEarlyStopping(keras.callbacks.Callback):
+    """keras.callbacks.EarlyStopping for each copy of a grouped model. When a copy has not
+       improved for patience epochs, its weights are set aside and its loss is gated off;
+       the set-aside weights are put back when training ends, so every copy ends with the
+       weights it had when it stopped (see get_grouped_callbacks for how this differs from
+       training it alone). Training ends once all copies stopped. Adds the mean monitored metric of active copies to the logs."""
+
+    def __init__(self, output_names, copies, gates, monitor='val_auroc', patience=20):
+        super().__init__()
+        metric = monitor[len('val_'):] if monitor.startswith('val_') else monitor
+        prefix = 'val_' if monitor.startswith('val_') else ''
+        self.monitors = [prefix+name+'_'+metric for name in output_names]
+        self.mean_monitor = prefix+'mean_'+metric
+        self.copies = copies
+        self.gates = gates
+        self.patience = patience
+
+
+    def on_train_begin(self, logs=None):
+        num_copies = len(self.copies)
+        self.best = [-np.inf]*num_copies
+        self.wait = [0]*num_copies
+        self.stopped_epoch = [None]*num_copies
+        self.snapshots = [None]*num_copies
+
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        active = [k for k in range(len(self.copies)) if self.stopped_epoch[k] is None]
+        values = [logs.get(self.monitors[k]) for k in active]
+        if None in values:
+            return
+        logs[self.mean_monitor] = float(np.mean(values))
+
+        for k, value in zip(active, values):
+            if value > self.best[k]:
+                self.best[k] = value
+                self.wait[k] = 0
+                continue
+            self.wait[k] += 1
+            if self.wait[k] >= self.patience:
+                print('trial %d: early stopping at epoch %d'%(k, epoch+1))
+                self.stopped_epoch[k] = epoch
+                self.snapshots[k] = self.copies[k].get_weights()
+                K.set_value(self.gates[k], 0.0)
+
+        if all(stopped is not None for stopped in self.stopped_epoch):
+            self.model.stop_training = True
+
+
+    def get_state(self):
+        return {'best': list(self.best), 'wait': list(self.wait), 'stopped_epoch': list(self.stopped_epoch),
+                'snapshots': list(self.snapshots), 'gates': [float(K.get_value(gate)) for gate in self.gates]}
+
+    def set_state(self, state):
+        self.best, self.wait = list(state['best']), list(state['wait'])
+        self.stopped_epoch, self.snapshots = list(state['stopped_epoch']), list(state['snapshots'])
+        for gate, value in zip(self.gates, state['gates']):
+            K.set_value(gate, value)
+
+
+    def on_train_end(self, logs=None):
+        for copy, snapshot in zip(self.copies, self.snapshots):
+            if snapshot is not None:
+                copy.set_weights(snapshot)
@@ -0,0 +1,225 @@
+import os
+import tempfile
+import numpy as np
+from tfomics import datasets
+
+
+
+MOTIF_CACHE_VERSION = 1
+
+
+class MotifDB():
+    """motif database held as a ragged array: the columns of all PWMs (4, total) side by
+       side with offsets (num+1,) marking where each motif starts, plus the same for the
+       reverse-complements. Motifs are looked up by index, ID (e.g. MA0002.2) or name
+       (e.g. RUNX1) through dicts; a repeated name maps to its first motif, as
+       motif_names.index(name) did."""
+
+    def __init__(self, ids, names, values, offsets):
+        self.ids = list(ids)
+        self.names = list(names)
+        self.values = np.asarray(values, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+        # reverse-complements share the offsets of the forward motifs
+        self.rc_values = np.empty_like(self.values)
+        for start, stop in zip(self.offsets[:-1], self.offsets[1:]):
+            self.rc_values[:, start:stop] = self.values[::-1, start:stop][:, ::-1]
+
+        self.id_index = {motif_id: i for i, motif_id in enumerate(self.ids)}
+        self.name_index = {}
+        for i, name in enumerate(self.names):
+            self.name_index.setdefault(name, i)
+
+
+    @classmethod
+    def load(cls, file_path, cache_dir=None, file_format=None):
+        """parse a JASPAR pfm or MEME file (format from the extension unless given); with
+           cache_dir the parsed database is stored as .npz keyed by the file's content
+           hash and later loads skip parsing"""
+
+        cache_path = None
+        if cache_dir:
+            key = datasets.file_hash(file_path, cache_dir)
+            cache_path = os.path.join(cache_dir, 'motifs_%s_v%d.npz'%(key, MOTIF_CACHE_VERSION))
+            if os.path.isfile(cache_path):
+                with np.load(cache_path) as f:
+                    return cls(f['ids'], f['names'], f['values'], f['offsets'])
+
+        if file_format is None:
+            file_format = 'meme' if file_path.endswith('.meme') else 'jaspar'
+        if file_format == 'meme':
+            ids, names, pwms = parse_meme(file_path)
+        elif file_format == 'jaspar':
+            ids, names, pwms = parse_jaspar(file_path)
+        else:
+            raise ValueError('unknown motif format: %s'%(file_format))
+        db = cls.from_pwms(ids, names, pwms)
+
+        if cache_path:
+            db.save(cache_path)
+        return db
+
+
+    @classmethod
+    def from_pwms(cls, ids, names, pwms):
+        widths = [pwm.shape[1] for pwm in pwms]
+        offsets = np.concatenate([[0], np.cumsum(widths)])
+        values = np.hstack(pwms) if pwms else np.zeros((4, 0))
+        return cls(ids, names, values, offsets)
+
+
+    def save(self, file_path):
+        """write the database as .npz; the file appears atomically"""
+        fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(file_path) or '.')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, ids=np.array(self.ids, dtype=str), names=np.array(self.names, dtype=str),
+                     values=self.values, offsets=self.offsets)
+        os.replace(tmp_path, file_path)
+
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __contains__(self, key):
+        return key in self.id_index or key in self.name_index
+
+    def __getitem__(self, key):
+        return self.pwm(key)
+
+
+    def index(self, key):
+        """motif index of an int, ID or name"""
+        if isinstance(key, (int, np.integer)):
+            return int(key)
+        if key in self.id_index:
+            return self.id_index[key]
+        if key in self.name_index:
+            return self.name_index[key]
+        raise KeyError(key)
+
+
+    def pwm(self, key, reverse=False):
+        """PWM (4, w) of a motif; a view into the ragged array"""
+        i = self.index(key)
+        values = self.rc_values if reverse else self.values
+        return values[:, self.offsets[i]:self.offsets[i+1]]
+
+
+    def width(self, key):
+        i = self.index(key)
+        return int(self.offsets[i+1] - self.offsets[i])
+
+
+    def get_motifs(self, keys, reverse_complement=False):
+        """list of PWMs for keys; with reverse_complement each PWM is followed by its
+           reverse-complement, as the core motifs of the synthetic datasets"""
+        motifs = []
+        for key in keys:
+            motifs.append(self.pwm(key))
+            if reverse_complement:
+                motifs.append(self.pwm(key, reverse=True))
+        return motifs
+
+
+
+#-------------------------------------------------------------------------------------------------
+# Parsers
+#-------------------------------------------------------------------------------------------------
+
+def parse_jaspar(file_path):
+    """parse a JASPAR pfm file: '>ID name' headers followed by 4 rows of counts (with or
+       without 'A [' ... ']' decoration). Any number of blank lines may separate motifs.
+       Counts are normalized to probabilities per column."""
+
+    ids, names, pwms = [], [], []
+    header, rows = None, []
+
+    def finish():
+        if header is None:
+            return
+        if len(rows) != 4:
+            raise ValueError('%s: motif %s has %d rows, expected 4'%(file_path, header[0], len(rows)))
+        pfm = np.array(rows, dtype=np.float64)
+        if len(set(len(row) for row in rows)) != 1:
+            raise ValueError('%s: motif %s has rows of different lengths'%(file_path, header[0]))
+        ids.append(header[0])
+        names.append(header[1])
+        pwms.append(normalize(pfm))
+
+    with open(file_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('>'):
+                finish()
+                fields = line[1:].split()
+                header = (fields[0], fields[1] if len(fields) > 1 else fields[0])
+                rows = []
+            else:
+                fields = line.replace('[', ' ').replace(']', ' ').split()
+                if fields and fields[0] in ('A', 'C', 'G', 'T'):
+                    fields = fields[1:]
+                rows.append([float(value) for value in fields])
+    finish()
+    return ids, names, pwms
+
+
+
+def parse_meme(file_path):
+    """parse a MEME (v4) motif file: 'MOTIF ID [name]' followed by a letter-probability
+       matrix with w rows of 4 probabilities"""
+
+    ids, names, pwms = [], [], []
+    with open(file_path) as f:
+        lines = f.read().splitlines()
+
+    header = None
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0] == 'MOTIF':
+            header = (fields[1], fields[2] if len(fields) > 2 else fields[1])
+        elif fields[0] == 'letter-probability' and header is not None:
+            info = line.split(':', 1)[1].replace('= ', '=').split()
+            info = dict(item.split('=', 1) for item in info if '=' in item)
+            if info.get('alength', '4') != '4':
+                raise ValueError('%s: motif %s is not a DNA motif'%(file_path, header[0]))
+
+            # without w, the matrix ends at the first line that is not numbers, which is
+            # left for the next motif
+            rows = []
+            width = int(info['w']) if 'w' in info else None
+            while i < len(lines) and (width is None or len(rows) < width):
+                if width is None and not is_numeric(lines[i]):
+                    break
+                if lines[i].strip():
+                    rows.append([float(value) for value in lines[i].split()])
+                i += 1
+            if width is not None and len(rows) != width:
+                raise ValueError('%s: motif %s is truncated'%(file_path, header[0]))
+
+            ids.append(header[0])
+            names.append(header[1])
+            pwms.append(normalize(np.array(rows, dtype=np.float64).T))
+            header = None
+    return ids, names, pwms
+
+
+
+def is_numeric(line):
+    try:
+        return len([float(value) for value in line.split()]) > 0
+    except ValueError:
+        return False
+
+
+def normalize(pfm):
+    """column-normalize counts (4, w); empty columns become uniform"""
+    total = np.sum(pfm, axis=0, keepdims=True)
+    return np.where(total > 0, pfm/np.maximum(total, 1e-12), 0.25)
@@ -0,0 +1,188 @@
+import numpy as np
+import h5py
+from multiprocessing import Pool
+
+
+
+# distribution over the number of motifs in a grammar (as cumulative thresholds) and the
+# offset added to it, as in generate_data/task1_* and task3_* notebooks
+TASK1_MOTIF_PROBS = [0, 0.5, 0.25, 0.17, 0.05, 0.3]
+TASK3_MOTIF_PROBS = [0, 0, 0.5, 0.25, 0.17, 0.05, 0.3]
+
+
+def add_reverse_complements(motifs):
+    """interleave each PWM (4, w) with its reverse-complement"""
+    rc_motifs = []
+    for pwm in motifs:
+        rc_motifs.append(pwm)
+        rc_motifs.append(pwm[::-1,::-1])
+    return rc_motifs
+
+
+
+def sample_grammars(motifs, num, seq_length, motif_probs, offset, sep_scale=1.0, rng=None):
+    """sample motif identities and spacings for a batch of grammars; invalid samples
+       (motifs longer than the sequence, rounding mismatches) are redrawn per row
+
+       returns motif ids (num, K) with -1 for unused slots, and motif start positions"""
+
+    rng = np.random.default_rng(rng)
+    widths = np.array([pwm.shape[1] for pwm in motifs])
+    cum_dist = np.cumsum(motif_probs)
+    max_motifs = len(cum_dist) - 1 + offset
+
+    sim_motifs = np.full((num, max_motifs), -1, dtype=np.int64)
+    distance = np.zeros(num, dtype=np.int64)
+    todo = np.arange(num)
+    while len(todo):
+        # number of motifs: last threshold below a uniform draw, plus offset
+        num_motifs = np.sum(rng.random(len(todo))[:,np.newaxis] > cum_dist, axis=1) - 1 + offset
+        ids = rng.integers(len(motifs), size=(len(todo), max_motifs))
+        ids[np.arange(max_motifs) >= num_motifs[:,np.newaxis]] = -1
+        dist = np.sum(np.where(ids >= 0, widths[ids], 0), axis=1)
+        valid = (dist > 0) & (dist < seq_length)
+        sim_motifs[todo[valid]] = ids[valid]
+        distance[todo[valid]] = dist[valid]
+        todo = todo[~valid]
+
+    # spacings before, between and after motifs must add up to the remainder
+    num_motifs = np.sum(sim_motifs >= 0, axis=1)
+    remainder = seq_length - distance
+    sep = np.zeros((num, max_motifs+1), dtype=np.int64)
+    todo = np.arange(num)
+    while len(todo):
+        draw = rng.uniform(0, sep_scale, size=(len(todo), max_motifs+1))
+        draw[np.arange(max_motifs+1) > num_motifs[todo,np.newaxis]] = 0
+        draw = np.round(draw/np.sum(draw, axis=1, keepdims=True)*remainder[todo,np.newaxis]).astype(np.int64)
+        valid = np.sum(draw, axis=1) == remainder[todo]
+        sep[todo[valid]] = draw[valid]
+        todo = todo[~valid]
+
+    # start of motif i is all spacings up to i plus the widths of earlier motifs
+    motif_widths = np.where(sim_motifs >= 0, widths[sim_motifs], 0)
+    starts = np.cumsum(sep[:,:-1], axis=1) + np.cumsum(motif_widths, axis=1) - motif_widths
+    return sim_motifs, starts
+
+
+
+def build_models(motifs, sim_motifs, starts, seq_length):
+    """sequence models (num, 4, L): motif columns at their starts, uniform elsewhere"""
+
+    # all motif columns side by side plus a uniform background column at the end
+    bank = np.hstack(list(motifs) + [np.ones((4,1))/4])
+    widths = np.array([pwm.shape[1] for pwm in motifs])
+    offsets = np.cumsum(widths) - widths
+    background = bank.shape[1] - 1
+
+    num = len(sim_motifs)
+    position = np.arange(seq_length)[np.newaxis,:]
+    column = np.full((num, seq_length), background, dtype=np.int64)
+    for k in range(sim_motifs.shape[1]):
+        ids = sim_motifs[:,k]
+        used = ids >= 0
+        start = starts[:,k:k+1]
+        inside = used[:,np.newaxis] & (position >= start) & (position < start + widths[ids][:,np.newaxis])
+        column = np.where(inside, offsets[ids][:,np.newaxis] + position - start, column)
+
+    return bank[:, column].transpose([1,0,2])
+
+
+
+def simulate_sequences(models, rng=None):
+    """sample one-hot sequences (num, 4, L) from sequence models (num, 4, L)"""
+
+    rng = np.random.default_rng(rng)
+    num, A, L = models.shape
+    cum_prob = np.cumsum(models, axis=1)
+    Z = rng.random((num, 1, L))
+    index = np.minimum(np.sum(cum_prob <= Z, axis=1), A-1)
+    return np.eye(A, dtype=np.float32)[index].transpose([0,2,1])
+
+
+
+def simulate_task1(core_motifs, num_seq, seq_length=200, rng=None):
+    """Task 1 dataset: grammars of 1-5 core motifs (motifs 2i and 2i+1 are a motif and its
+       reverse-complement); labels mark which core motifs are present"""
+
+    rng = np.random.default_rng(rng)
+    sim_motifs, starts = sample_grammars(core_motifs, num_seq, seq_length, TASK1_MOTIF_PROBS,
+                                         offset=1, sep_scale=1.0, rng=rng)
+    models = build_models(core_motifs, sim_motifs, starts, seq_length)
+    x = simulate_sequences(models, rng)
+
+    labels = np.zeros((num_seq, len(core_motifs)//2), dtype=np.float32)
+    rows, slots = np.where(sim_motifs >= 0)
+    labels[rows, sim_motifs[rows, slots]//2] = 1
+    return x, labels, models.astype(np.float32)
+
+
+
+def simulate_task3(core_motifs, background_motifs, num_seq, seq_length=200, rng=None):
+    """Task 3 dataset: half positive grammars of core motifs, half negative grammars of
+       background motifs (which include the core motifs), shuffled together"""
+
+    rng = np.random.default_rng(rng)
+    num_pos = num_seq//2
+    x, models = [], []
+    for motifs, num in [(core_motifs, num_pos), (background_motifs, num_seq - num_pos)]:
+        sim_motifs, starts = sample_grammars(motifs, num, seq_length, TASK3_MOTIF_PROBS,
+                                             offset=2, sep_scale=2.0, rng=rng)
+        model = build_models(motifs, sim_motifs, starts, seq_length)
+        x.append(simulate_sequences(model, rng))
+        models.append(model.astype(np.float32))
+    labels = np.vstack([np.ones((num_pos,1)), np.zeros((num_seq-num_pos,1))]).astype(np.float32)
+
+    shuffle = rng.permutation(num_seq)
+    return np.concatenate(x)[shuffle], labels[shuffle], np.concatenate(models)[shuffle]
+
+
+
+#-------------------------------------------------------------------------------------------------
+# Parallel, sharded generation into HDF5
+#-------------------------------------------------------------------------------------------------
+
+def simulate_shard(args):
+    simulate_fn, num, seed, kwargs = args
+    return simulate_fn(num_seq=num, rng=np.random.default_rng(seed), **kwargs)
+
+
+def generate_dataset(file_path, simulate_fn, num_seq, split_size=(0.7, 0.1, 0.2), shard_size=10000,
+                     num_workers=1, seed=None, compression='gzip', **kwargs):
+    """simulate a dataset in shards across processes and stream it into HDF5 with the
+       X/Y/model_{train,valid,test} layout of the generate_data notebooks.
+
+       Each shard gets its own seed spawned from seed, so the output does not depend on
+       num_workers. Every shard is split into train/valid/test by split_size; as the
+       sequences are independent this matches a global shuffle and split.
+       simulate_fn is e.g. simulate_task1 and kwargs its motif arguments."""
+
+    num_shards = int(np.ceil(num_seq/shard_size))
+    seeds = np.random.SeedSequence(seed).spawn(num_shards)
+    sizes = [min(shard_size, num_seq - i*shard_size) for i in range(num_shards)]
+    jobs = [(simulate_fn, size, shard_seed, kwargs) for size, shard_seed in zip(sizes, seeds)]
+    bounds = np.cumsum([0] + list(split_size))
+
+    # workers are started before the output file is opened
+    pool = Pool(num_workers) if num_workers > 1 else None
+    shards = pool.imap(simulate_shard, jobs) if pool else map(simulate_shard, jobs)
+    with h5py.File(file_path, 'w') as f:
+        for x, y, model in shards:
+            cut = np.round(bounds*len(x)).astype(int)
+            for i, split in enumerate(['train', 'valid', 'test']):
+                for name, values in [('X_', x), ('Y_', y), ('model_', model)]:
+                    append(f, name+split, values[cut[i]:cut[i+1]], compression)
+    if pool:
+        pool.close()
+        pool.join()
+
+
+
+def append(f, key, values, compression=None):
+    if key not in f:
+        chunks = (max(1, min(1000, len(values))),) + values.shape[1:]
+        f.create_dataset(key, shape=(0,) + values.shape[1:], maxshape=(None,) + values.shape[1:],
+                         dtype=values.dtype, chunks=chunks, compression=compression)
+    dataset = f[key]
+    start = dataset.shape[0]
+    dataset.resize(start + len(values), axis=0)
+    dataset[start:] = values
@@ -0,0 +1,647 @@
+import os
+import json
+import time
+import uuid
+import socket
+import itertools
+import threading
+import traceback
+import contextlib
+import multiprocessing
+import numpy as np
+from tensorflow import keras
+from tfomics import datasets
+
+
+
+def expand_jobs(**axes):
+    """expand sweep axes (e.g. model_name, activation, trial) into a list of jobs, one dict
+       per combination in the order the axes are given. Each job is named by joining its
+       values with '_', as the scripts name their runs (e.g. cnn-deep_relu_0)."""
+
+    keys = list(axes.keys())
+    jobs = []
+    for values in itertools.product(*[list(axes[key]) for key in keys]):
+        job = dict(zip(keys, values))
+        job['name'] = '_'.join(str(value) for value in values)
+        jobs.append(job)
+    return jobs
+
+
+
+class Manifest():
+    """record of finished runs in results_dir/runs, one JSON file per run holding the job,
+       its results and the artifacts it wrote. A run counts as done only if its record
+       and all of its artifacts exist, so reruns repeat runs that crashed part way."""
+
+    def __init__(self, results_dir):
+        self.path = os.path.join(results_dir, 'runs')
+        os.makedirs(self.path, exist_ok=True)
+
+
+    def record_path(self, name):
+        return os.path.join(self.path, name+'.json')
+
+
+    def get(self, name):
+        """the record of a run, or None if it has none"""
+        try:
+            with open(self.record_path(name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+
+    def done(self, name):
+        record = self.get(name)
+        if record is None:
+            return False
+        return all(os.path.exists(path) for path in record['artifacts'])
+
+
+    def record(self, job, results, artifacts=(), elapsed=None, status='done'):
+        record = {'job': job, 'results': results, 'artifacts': list(artifacts),
+                  'elapsed': elapsed, 'status': status, 'finished': time.time()}
+        datasets.atomic_write(self.record_path(job['name']), json.dumps(record, indent=1))
+        return record
+
+
+    def records(self):
+        records = {}
+        for file_name in sorted(os.listdir(self.path)):
+            if file_name.endswith('.json'):
+                record = self.get(file_name[:-len('.json')])
+                if record:
+                    records[record['job']['name']] = record
+        return records
+
+
+
+@contextlib.contextmanager
+def atomic_output(file_path):
+    """yield a temporary path next to file_path (with the same extension, so writers that
+       pick a format from it still work) and move it into place only on success"""
+
+    root, ext = os.path.splitext(file_path)
+    tmp_path = '%s.tmp%d%s'%(root, os.getpid(), ext)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+
+#-------------------------------------------------------------------------------------------------
+# Process pool
+#-------------------------------------------------------------------------------------------------
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None, cpus=None):
+    """limit this process to a set of cpus and the TensorFlow/BLAS thread pools to a number
+       of threads; must run before TensorFlow executes any op"""
+
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    if intra_op_threads:
+        for key in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+            os.environ[key] = str(intra_op_threads)
+
+    import tensorflow as tf
+    try:
+        if intra_op_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        if inter_op_threads:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError:
+        print('TensorFlow is already initialized, thread limits are not applied')
+
+
+def cpu_slots(num_workers, pin_cpus=False):
+    """split the cpus available to this process into one disjoint set per worker"""
+    cpus = sorted(os.sched_getaffinity(0))
+    per_worker = max(1, len(cpus)//num_workers)
+    slots = []
+    for i in range(num_workers):
+        slot = cpus[(i*per_worker)%len(cpus):][:per_worker]
+        slots.append(slot if pin_cpus else None)
+    return slots, per_worker
+
+
+def init_worker(slots, intra_op_threads, inter_op_threads, initializer, initargs):
+    cpus = slots.get()
+    configure_threads(intra_op_threads, inter_op_threads, cpus)
+    if initializer:
+        initializer(*initargs)
+
+
+def run_job(args):
+    """run one job and record it; errors are returned rather than raised so that one
+       failed run does not stop the sweep. Returns the job name, the error (or None) and
+       the status of the run."""
+
+    run_fn, job, results_dir, deadline = args
+    if deadline:
+        if time.time() >= deadline:
+            return job['name'], None, 'skipped'
+        # run_fn gets the deadline to stop at a checkpoint in time (training.Budget)
+        job_args = dict(job, deadline=deadline)
+    else:
+        job_args = job
+
+    start = time.time()
+    try:
+        results, artifacts = run_fn(job_args)
+    except Exception:
+        return job['name'], traceback.format_exc(), 'failed'
+    if results.get('paused_epoch') is not None:
+        # stopped by its budget; not recorded, so the next sweep resumes it
+        return job['name'], None, 'paused'
+
+    # runs stopped by a SuccessiveHalving scheduler or a TrainingMonitor, or restarted by
+    # fit_with_restarts, report it
+    status = 'done'
+    if results.get('pruned_epoch'):
+        status = 'pruned'
+    if results.get('restarts'):
+        status = 'restarted'
+    if results.get('diverged'):
+        status = 'diverged'
+    Manifest(results_dir).record(job, results, artifacts, time.time() - start, status)
+    return job['name'], None, status
+
+
+
+def run_sweep(run_fn, jobs, results_dir, num_workers=1, intra_op_threads=None, inter_op_threads=1,
+              pin_cpus=False, initializer=None, initargs=(), deadline=None, order_by=None,
+              group_keys=None):
+    """run every job that is not done yet in the manifest of results_dir.
+
+       run_fn(job) trains and evaluates one run and returns (results, artifacts): a JSON-
+       serializable dict and the paths it wrote (weights, filters, ...). Each finished run
+       is recorded atomically right away. With num_workers > 1 jobs run in a pool of fresh
+       (spawned) processes, each limited to intra_op_threads (default: its share of the
+       cpus) and optionally pinned to its own cpus; initializer(*initargs) runs once per
+       worker, e.g. to attach shared data. run_fn and initializer must be importable,
+       i.e. defined at module level of a script whose sweep runs under __main__.
+
+       For a fixed time window, deadline (a time.time() value) is passed to run_fn as
+       job['deadline'] and jobs are not started after it; order_by (e.g. 'trial') runs the
+       first trial of every configuration before any second trial, so an unfinished sweep
+       still covers every configuration. Job durations are predicted from the recorded
+       runs of the same group_keys (e.g. model_name, activation), and predicted versus
+       actual times are reported at the end and in results_dir/schedule.tsv.
+
+       Returns the names of failed runs mapped to their tracebacks."""
+
+    manifest = Manifest(results_dir)
+    todo = [job for job in jobs if not manifest.done(job['name'])]
+    print('sweep: %d runs, %d done, %d to run'%(len(jobs), len(jobs) - len(todo), len(todo)))
+    if order_by:
+        todo = sorted(todo, key=lambda job: job.get(order_by, 0))
+    tasks = [(run_fn, job, results_dir, deadline) for job in todo]
+
+    start = time.time()
+    estimates = estimate_durations(todo, manifest, group_keys)
+    plan = plan_schedule(todo, estimates, num_workers, start)
+    report_plan(plan, start, deadline)
+
+    failed, actual = {}, {}
+    def report(name, error, status):
+        actual[name] = (time.time(), status)
+        if error:
+            failed[name] = error
+            print('run %s failed:\n%s'%(name, error))
+        else:
+            print('run %s %s'%(name, status))
+
+    if num_workers == 1:
+        if initializer:
+            initializer(*initargs)
+        for task in tasks:
+            report(*run_job(task))
+    else:
+        slots, per_worker = cpu_slots(num_workers, pin_cpus)
+        context = multiprocessing.get_context('spawn')
+        queue = context.Queue()
+        for slot in slots:
+            queue.put(slot)
+        initargs = (queue, intra_op_threads or per_worker, inter_op_threads, initializer, initargs)
+
+        with context.Pool(num_workers, init_worker, initargs) as pool:
+            for name, error, status in pool.imap_unordered(run_job, tasks):
+                report(name, error, status)
+
+    write_schedule(os.path.join(results_dir, 'schedule.tsv'), plan, actual, start)
+    return failed
+
+
+
+def estimate_durations(jobs, manifest, group_keys=None):
+    """predicted seconds per job: the mean elapsed time of recorded runs with the same
+       values of group_keys, else of all recorded runs; None without any record"""
+
+    records = [record for record in manifest.records().values() if record.get('elapsed')]
+    overall = np.mean([record['elapsed'] for record in records]) if records else None
+    group_keys = group_keys or []
+
+    groups = {}
+    for record in records:
+        key = tuple(record['job'].get(k) for k in group_keys)
+        groups.setdefault(key, []).append(record['elapsed'])
+
+    estimates = {}
+    for job in jobs:
+        elapsed = groups.get(tuple(job.get(k) for k in group_keys))
+        estimates[job['name']] = float(np.mean(elapsed)) if elapsed else overall
+    return estimates
+
+
+def plan_schedule(jobs, estimates, num_workers, start):
+    """predicted (start, end) time of each job when jobs are handed in order to the first
+       free worker; jobs without an estimate get the mean estimate"""
+
+    known = [value for value in estimates.values() if value is not None]
+    default = np.mean(known) if known else None
+    free = [start]*num_workers
+    plan = {}
+    for job in jobs:
+        duration = estimates.get(job['name']) or default
+        if duration is None:
+            return {}
+        worker = int(np.argmin(free))
+        plan[job['name']] = (free[worker], free[worker] + duration)
+        free[worker] += duration
+    return plan
+
+
+def report_plan(plan, start, deadline=None):
+    if not plan:
+        print('no recorded runs yet to predict durations from')
+        return
+    end = max(finish for _, finish in plan.values())
+    print('predicted end of sweep in %.1f h'%((end - start)/3600))
+    if deadline:
+        fits = sum(1 for _, finish in plan.values() if finish <= deadline)
+        print('predicted to finish before the deadline: %d of %d runs'%(fits, len(plan)))
+
+
+def write_schedule(file_path, plan, actual, start):
+    """predicted versus actual end of each run (hours from the start of the sweep)"""
+    with open(file_path, 'w') as f:
+        f.write('%s\t%s\t%s\t%s\n'%('run', 'predicted end', 'actual end', 'status'))
+        for name, (finish, status) in sorted(actual.items(), key=lambda item: item[1][0]):
+            predicted = '%.3f'%((plan[name][1] - start)/3600) if name in plan else 'nan'
+            f.write('%s\t%s\t%.3f\t%s\n'%(name, predicted, (finish - start)/3600, status))
+    predicted = [plan[name][1] for name in actual if name in plan]
+    if predicted:
+        actual_end = max(finish for finish, _ in actual.values())
+        print('sweep took %.2f h, predicted %.2f h'%((actual_end - start)/3600, (max(predicted) - start)/3600))
+
+
+
+#-------------------------------------------------------------------------------------------------
+# Asynchronous successive halving
+#-------------------------------------------------------------------------------------------------
+
+class SuccessiveHalving():
+    """asynchronous successive-halving (ASHA) early termination for the runs of a sweep.
+       Rungs are at min_epoch*reduction_factor^k epochs. A run reaching a rung reports its
+       monitored metric and continues only if it is among the top 1/reduction_factor of
+       all values reported at that rung so far by the runs of its group (e.g. the trials
+       of one configuration, so that a configuration is not pruned for being worse than
+       another); the first min_reports runs of a group at a rung always continue. Rung
+       values and pruned runs are kept as files under path, so the runs may live in
+       different processes or on different nodes."""
+
+    def __init__(self, path, monitor='val_aupr', mode='max', min_epoch=4, reduction_factor=3,
+                 max_epoch=100, min_reports=None):
+        self.path = path
+        self.monitor = monitor
+        self.mode = mode
+        self.reduction_factor = reduction_factor
+        self.min_reports = min_reports if min_reports else reduction_factor
+        self.rungs = []
+        epoch = min_epoch
+        while epoch < max_epoch:
+            self.rungs.append(epoch)
+            epoch *= reduction_factor
+        os.makedirs(os.path.join(path, 'pruned'), exist_ok=True)
+
+
+    def rung_path(self, epoch, group=None):
+        return os.path.join(self.path, 'rung_%d'%(epoch), group if group else '_')
+
+
+    def report(self, name, epoch, value, group=None):
+        """record a run's value at a rung of its group; returns False if the run should
+           stop"""
+
+        rung_path = self.rung_path(epoch, group)
+        os.makedirs(rung_path, exist_ok=True)
+        datasets.atomic_write(os.path.join(rung_path, name+'.json'), json.dumps({'value': value}))
+
+        values = []
+        for file_name in os.listdir(rung_path):
+            if file_name.endswith('.json'):
+                try:
+                    with open(os.path.join(rung_path, file_name)) as f:
+                        values.append(json.load(f)['value'])
+                except (FileNotFoundError, ValueError):
+                    continue
+        if len(values) < self.min_reports:
+            return True
+
+        if np.isnan(value):
+            return False
+        values = np.array(values, dtype=float)
+        values = np.where(np.isnan(values), -np.inf if self.mode == 'max' else np.inf, values)
+        num_promote = max(1, len(values)//self.reduction_factor)
+        ranked = np.sort(values)[::-1] if self.mode == 'max' else np.sort(values)
+        threshold = ranked[num_promote-1]
+        return bool(value >= threshold if self.mode == 'max' else value <= threshold)
+
+
+    def prune(self, name, epoch, value, group=None):
+        record = {'name': name, 'group': group, 'epoch': epoch, 'monitor': self.monitor, 'value': value}
+        datasets.atomic_write(os.path.join(self.path, 'pruned', name+'.json'), json.dumps(record))
+
+
+    def pruned(self):
+        """records of every pruned run"""
+        records = {}
+        pruned_path = os.path.join(self.path, 'pruned')
+        for file_name in sorted(os.listdir(pruned_path)):
+            with open(os.path.join(pruned_path, file_name)) as f:
+                record = json.load(f)
+            records[record['name']] = record
+        return records
+
+
+    def callback(self, name, group=None):
+        return SuccessiveHalvingCallback(self, name, group)
+
+
+
+class SuccessiveHalvingCallback(keras.callbacks.Callback):
+    """stops training when the scheduler prunes the run at a rung; pruned_epoch is then
+       the epoch it stopped at"""
+
+    def __init__(self, scheduler, name, group=None):
+        super().__init__()
+        self.scheduler = scheduler
+        self.run_name = name
+        self.group = group
+        self.pruned_epoch = None
+
+    def get_state(self):
+        return {'pruned_epoch': self.pruned_epoch}
+
+    def set_state(self, state):
+        self.pruned_epoch = state['pruned_epoch']
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch += 1
+        if epoch not in self.scheduler.rungs or self.scheduler.monitor not in (logs or {}):
+            return
+        value = float(logs[self.scheduler.monitor])
+        if not self.scheduler.report(self.run_name, epoch, value, self.group):
+            print('pruned %s at epoch %d: %s=%.4f'%(self.run_name, epoch, self.scheduler.monitor, value))
+            self.scheduler.prune(self.run_name, epoch, value, self.group)
+            self.pruned_epoch = epoch
+            self.model.stop_training = True
+
+
+
+#-------------------------------------------------------------------------------------------------
+# Job queue on a shared filesystem
+#-------------------------------------------------------------------------------------------------
+
+class JobQueue():
+    """job queue kept as a directory on a shared (e.g. NFS) filesystem, so workers on any
+       number of nodes can drain a sweep without a broker. A job is a JSON file that moves
+       between pending/, claimed/, done/ and failed/ by rename, which is atomic: only one
+       worker wins a claim. The claim file is the lease; its owner touches it every
+       heartbeat seconds, and a claim not touched for lease_time seconds (its worker died
+       or hung) goes back to pending for another attempt, up to max_attempts.
+
+       File names carry the state: pending/<name>@<attempt>.json and
+       claimed/<name>@<attempt>@<worker>.json. Lease ages are measured against the file
+       server's clock, so clock skew between nodes does not expire leases early."""
+
+    states = ['pending', 'claimed', 'done', 'failed']
+
+    def __init__(self, path, lease_time=600, heartbeat=None, max_attempts=3, worker_id=None):
+        self.path = path
+        self.lease_time = lease_time
+        self.heartbeat = heartbeat if heartbeat else lease_time/4
+        self.max_attempts = max_attempts
+        if worker_id is None:
+            worker_id = '%s-%d-%s'%(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+        self.worker_id = worker_id.replace('@', '-')
+        for state in self.states + ['names', 'tasks']:
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+
+    def put(self, jobs):
+        """add jobs that were never added before; a name is registered with an exclusive
+           create, so several nodes may submit the same sweep and each job is queued once"""
+
+        added = 0
+        for job in jobs:
+            try:
+                fd = os.open(os.path.join(self.path, 'names', job['name']), os.O_CREAT | os.O_EXCL)
+            except FileExistsError:
+                continue
+            os.close(fd)
+            datasets.atomic_write(self.job_path('pending', job['name'], 0), json.dumps(job))
+            added += 1
+        if added:
+            # new jobs need the tasks run once the queue is drained to run again
+            for file_name in os.listdir(os.path.join(self.path, 'tasks')):
+                os.remove(os.path.join(self.path, 'tasks', file_name))
+        return added
+
+
+    def job_path(self, state, name, attempt=None, worker=None):
+        parts = [name] + [str(value) for value in [attempt, worker] if value is not None]
+        return os.path.join(self.path, state, '@'.join(parts)+'.json')
+
+
+    def listdir(self, state):
+        return sorted(file_name for file_name in os.listdir(os.path.join(self.path, state))
+                      if file_name.endswith('.json'))
+
+
+    def status(self):
+        return {state: len(self.listdir(state)) for state in self.states}
+
+
+    def drained(self):
+        """True once no job is pending or claimed"""
+        return not self.listdir('pending') and not self.listdir('claimed')
+
+
+    def run_once(self, task):
+        """True for only one caller over all workers (an exclusive create of
+           tasks/<task>), e.g. for the worker that consolidates results after drain"""
+        try:
+            fd = os.open(os.path.join(self.path, 'tasks', task), os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            return False
+        os.close(fd)
+        return True
+
+
+    def server_time(self):
+        """current time on the file server, read from the mtime of a freshly touched file"""
+        clock_path = os.path.join(self.path, 'clock')
+        with open(clock_path, 'a'):
+            os.utime(clock_path, None)
+        return os.stat(clock_path).st_mtime
+
+
+    def claim(self):
+        """claim the next pending job after requeueing expired leases; returns a Lease or
+           None if nothing is pending"""
+
+        self.reap()
+        for file_name in self.listdir('pending'):
+            name, attempt = file_name[:-len('.json')].rsplit('@', 1)
+            pending_path = os.path.join(self.path, 'pending', file_name)
+            claim_path = self.job_path('claimed', name, attempt, self.worker_id)
+            try:
+                # rename keeps the mtime, so touch first or the claim would look expired
+                os.utime(pending_path, None)
+                os.rename(pending_path, claim_path)
+            except FileNotFoundError:
+                # another worker claimed it first
+                continue
+            with open(claim_path) as f:
+                job = json.load(f)
+            return Lease(self, job, int(attempt), claim_path)
+        return None
+
+
+    def reap(self):
+        """move claims whose lease expired back to pending, or to failed after the last
+           attempt"""
+
+        now = self.server_time()
+        for file_name in self.listdir('claimed'):
+            claim_path = os.path.join(self.path, 'claimed', file_name)
+            try:
+                expired = now - os.stat(claim_path).st_mtime > self.lease_time
+            except FileNotFoundError:
+                continue
+            if expired:
+                name, attempt, worker = file_name[:-len('.json')].rsplit('@', 2)
+                print('lease of %s held by %s expired'%(name, worker))
+                self.retry(claim_path, name, int(attempt))
+
+
+    def retry(self, claim_path, name, attempt):
+        if attempt + 1 < self.max_attempts:
+            target = self.job_path('pending', name, attempt+1)
+        else:
+            target = self.job_path('failed', name)
+        try:
+            os.rename(claim_path, target)
+        except FileNotFoundError:
+            pass
+
+
+    def complete(self, lease, error=None):
+        """mark a claimed job done, or requeue it for another attempt if it failed; a
+           worker that lost its lease leaves the job to whoever holds it now"""
+
+        lease.stop()
+        if error:
+            self.retry(lease.path, lease.job['name'], lease.attempt)
+            return
+        try:
+            os.rename(lease.path, self.job_path('done', lease.job['name']))
+        except FileNotFoundError:
+            pass
+
+
+    def drain(self, run_fn, results_dir, poll=30, deadline=None):
+        """claim and run jobs until none are pending or claimed (or the deadline passed).
+           Runs are recorded in the manifest of results_dir as in run_sweep, and jobs found
+           done there are not run again (e.g. after a lease expired on a slow but live
+           worker). A run paused by its budget goes back to pending."""
+
+        manifest = Manifest(results_dir)
+        failed = {}
+        while not deadline or time.time() < deadline:
+            lease = self.claim()
+            if lease is None:
+                if not self.listdir('claimed'):
+                    break
+                # other workers still hold jobs that may come back if they die
+                time.sleep(poll)
+                continue
+
+            name, error, status = lease.job['name'], None, 'done'
+            if not manifest.done(name):
+                print('worker %s runs %s (attempt %d)'%(self.worker_id, name, lease.attempt+1))
+                with lease:
+                    name, error, status = run_job((run_fn, lease.job, results_dir, deadline))
+            if error:
+                failed[name] = error
+                print('run %s failed:\n%s'%(name, error))
+            if status in ['paused', 'skipped']:
+                self.release(lease)
+            else:
+                self.complete(lease, error)
+        return failed
+
+
+    def release(self, lease):
+        """give a claimed job back without using up an attempt"""
+        lease.stop()
+        try:
+            os.rename(lease.path, self.job_path('pending', lease.job['name'], lease.attempt))
+        except FileNotFoundError:
+            pass
+
+
+
+class Lease():
+    """a claimed job; while entered, a background thread touches the claim file every
+       heartbeat seconds to keep the lease alive"""
+
+    def __init__(self, queue, job, attempt, path):
+        self.queue = queue
+        self.job = job
+        self.attempt = attempt
+        self.path = path
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+
+    def beat(self):
+        while not self.stopped.wait(self.queue.heartbeat):
+            try:
+                os.utime(self.path, None)
+            except FileNotFoundError:
+                # the lease expired and the job was requeued
+                self.lost = True
+                print('lost lease of %s'%(self.job['name']))
+                return
+
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
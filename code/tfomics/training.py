@@ -0,0 +1,600 @@
+import os
+import json
+import glob
+import time
+import shutil
+import weakref
+import zlib
+import collections
+import numpy as np
+from six.moves import cPickle
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.keras import backend as K
+import tensorflow.compat.v1.keras.backend as K1
+
+
+
+# attributes that hold the training state of keras callbacks; callbacks of our own
+# provide get_state() and set_state() instead
+CALLBACK_STATE = {'EarlyStopping': ['wait', 'best', 'stopped_epoch'],
+                  'ReduceLROnPlateau': ['wait', 'best', 'cooldown_counter']}
+
+
+def get_callback_state(callback):
+    if hasattr(callback, 'get_state'):
+        return callback.get_state()
+    names = CALLBACK_STATE.get(type(callback).__name__, [])
+    return {name: getattr(callback, name) for name in names}
+
+
+def set_callback_state(callback, state):
+    if hasattr(callback, 'set_state'):
+        callback.set_state(state)
+        return
+    for name, value in state.items():
+        setattr(callback, name, value)
+
+
+
+class Checkpoint(keras.callbacks.Callback):
+    """save everything needed to resume training at the end of every period epochs:
+       model weights, optimizer weights (slots and iteration count), learning rate, the
+       epoch and the state of the other callbacks (early stopping, learning-rate decay,
+       ...). Checkpoints are written atomically to path/ckpt_<epoch>.pkl and only the last
+       keep are kept.
+
+       To resume, pass initial_epoch=checkpoint.initial_epoch to fit and put the checkpoint
+       after the callbacks it restores, as they reset their state when training begins.
+       The order of shuffled batches is not restored. An epoch in which monitor (a
+       TrainingMonitor) stopped a diverged run is not saved; a run stopped by budget (a
+       Budget, put before the checkpoint) is saved to be resumed rather than as finished."""
+
+    def __init__(self, path, callbacks=(), keep=2, period=1, monitor=None, budget=None):
+        super().__init__()
+        self.path = path
+        self.callbacks = list(callbacks)
+        self.keep = keep
+        self.period = period
+        self.monitor = monitor
+        self.budget = budget
+        self.state = self.load()
+
+
+    def checkpoints(self):
+        return sorted(glob.glob(os.path.join(self.path, 'ckpt_*.pkl')))
+
+
+    def load(self):
+        """the latest checkpoint that can be read, or None"""
+        for file_path in self.checkpoints()[::-1]:
+            try:
+                with open(file_path, 'rb') as f:
+                    return cPickle.load(f)
+            except (EOFError, cPickle.UnpicklingError):
+                continue
+        return None
+
+
+    @property
+    def initial_epoch(self):
+        """epoch to pass to fit: the one after the latest checkpoint, or the last epoch if
+           training had already finished"""
+        if self.state is None:
+            return 0
+        if self.state['stop_training']:
+            return self.state['epochs']
+        return self.state['epoch'] + 1
+
+
+    def on_train_begin(self, logs=None):
+        if self.state is None:
+            return
+        print('resuming from epoch %d of %s'%(self.state['epoch']+1, self.path))
+        self.model.set_weights(self.state['weights'])
+        set_optimizer_weights(self.model, self.state['optimizer'])
+        K.set_value(self.model.optimizer.lr, self.state['lr'])
+        for callback, state in zip(self.callbacks, self.state['callbacks']):
+            set_callback_state(callback, state)
+
+
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.monitor is not None and self.monitor.event:
+            # the weights of a diverged epoch are not worth resuming from
+            return
+        if (epoch + 1)%self.period and not self.model.stop_training:
+            return
+        # a run stopped by its time budget is resumed, not finished
+        paused = self.budget is not None and self.budget.stopped_epoch == epoch
+        state = {'epoch': epoch,
+                 'epochs': self.params.get('epochs'),
+                 'stop_training': bool(self.model.stop_training) and not paused,
+                 'weights': self.model.get_weights(),
+                 'optimizer': K.batch_get_value(optimizer_variables(self.model.optimizer)),
+                 'lr': float(K.get_value(self.model.optimizer.lr)),
+                 'callbacks': [get_callback_state(callback) for callback in self.callbacks],
+                 'logs': dict(logs or {})}
+        self.save(state)
+
+
+    def save(self, state):
+        os.makedirs(self.path, exist_ok=True)
+        file_path = os.path.join(self.path, 'ckpt_%04d.pkl'%(state['epoch']))
+        tmp_path = file_path + '.tmp%d'%(os.getpid())
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(state, f, protocol=cPickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, file_path)
+        self.state = state
+        for old_path in self.checkpoints()[:-self.keep]:
+            os.remove(old_path)
+
+
+    def clear(self):
+        """remove the checkpoints of a run once its results are saved"""
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.state = None
+
+
+
+#-------------------------------------------------------------------------------------------------
+# Model reuse
+#-------------------------------------------------------------------------------------------------
+
+class ModelCache():
+    """build and compile each model once per process and reuse it for later trials. 
+       get(*key, seed=seed) calls build_fn(*key) and compile_fn(model) the first time a
+       key is seen; afterwards the cached model gets new initial weights drawn with seed
+       and a reset optimizer (slots, iteration count and learning rate), which is much
+       faster than keras.backend.clear_session() and a rebuild in graph mode. Once
+       max_models are cached the session is cleared and the cache starts over.
+
+       The initial weights are drawn with seed and the key together, so trial k of one
+       model or activation does not start from the same draws as trial k of another."""
+
+    def __init__(self, build_fn, compile_fn=None, max_models=None):
+        self.build_fn = build_fn
+        self.compile_fn = compile_fn
+        self.max_models = max_models
+        self.models = {}
+        self.learning_rates = {}
+
+
+    def get(self, *key, seed=None):
+        model = self.models.get(key)
+        if model is None:
+            if self.max_models and len(self.models) >= self.max_models:
+                self.clear()
+            model = self.build_fn(*key)
+            if self.compile_fn:
+                self.compile_fn(model)
+            self.models[key] = model
+            if model.optimizer is not None:
+                self.learning_rates[key] = float(K.get_value(model.optimizer.lr))
+            if seed is None:
+                return model
+        reinitialize(model, key_seed(key, seed))
+        if model.optimizer is not None:
+            reset_optimizer(model, self.learning_rates[key])
+        return model
+
+
+    def clear(self):
+        K.clear_session()
+        self.models, self.learning_rates = {}, {}
+
+
+
+class WeightCache():
+    """trained weights of one built model's architecture, read once into numpy arrays and
+       swapped into the model with set_weights, e.g. to evaluate many trials with many
+       methods without rebuilding the model. The least recently used weights are dropped
+       once the cache holds more than max_bytes. Weights are read from weight files, or
+       by run name from a WeightArchive."""
+
+    def __init__(self, model, max_bytes=2**30, archive=None):
+        self.model = model
+        self.max_bytes = max_bytes
+        self.archive = archive
+        self.weights = collections.OrderedDict()
+        self.nbytes = 0
+
+
+    def read(self, file_path):
+        if self.archive is not None:
+            weights = self.archive.get(file_path)
+            self.model.set_weights(weights)
+        else:
+            self.model.load_weights(file_path)
+            weights = self.model.get_weights()
+        self.weights[file_path] = weights
+        self.nbytes += sum(weight.nbytes for weight in weights)
+        while self.nbytes > self.max_bytes and len(self.weights) > 1:
+            _, dropped = self.weights.popitem(last=False)
+            self.nbytes -= sum(weight.nbytes for weight in dropped)
+
+
+    def preload(self, file_paths):
+        """read weight files (or runs) until the cache is full"""
+        for file_path in file_paths:
+            if file_path not in self.weights:
+                if self.weights and self.nbytes*(len(self.weights) + 1)/len(self.weights) > self.max_bytes:
+                    break
+                self.read(file_path)
+
+
+    def load(self, file_path):
+        """the model with the weights of file_path (or run)"""
+        if file_path in self.weights:
+            self.weights.move_to_end(file_path)
+            self.model.set_weights(self.weights[file_path])
+        else:
+            self.read(file_path)
+        return self.model
+
+
+
+def weight_initializer(layer, weight):
+    """the initializer layer created weight with, e.g. layer.kernel_initializer for its
+       kernel or layer.moving_variance_initializer for a BatchNormalization variance"""
+    name = weight.name.split('/')[-1].split(':')[0]
+    if not hasattr(layer, name+'_initializer'):
+        return None
+    # add_weight falls back to glorot_uniform when a layer is given no initializer
+    return getattr(layer, name+'_initializer') or 'glorot_uniform'
+
+
+def key_seed(key, seed):
+    """seed of the random state of a ModelCache key and trial seed; the key is hashed
+       with crc32, which unlike hash() is the same in every process"""
+    if seed is None:
+        return None
+    return [seed, zlib.crc32(repr(key).encode())]
+
+
+def reinitialize(model, seed=None):
+    """draw new initial values for every weight of model, including non-trainable ones
+       such as BatchNormalization moving statistics, from its layer's initializers, seeded
+       from seed (an int or a sequence of ints). Raises ValueError if a weight has no
+       initializer, as it would otherwise keep its trained value."""
+
+    rng = np.random.RandomState(seed)
+    updates, missing = [], []
+    for layer in flatten_layers(model):
+        for weight in layer.weights:
+            initializer = weight_initializer(layer, weight)
+            if initializer is None:
+                missing.append(weight.name)
+                continue
+            value = sample_initializer(keras.initializers.get(initializer), tuple(weight.shape), rng)
+            updates.append((weight, value))
+    if missing:
+        raise ValueError('no initializer to reset weights: %s'%(', '.join(missing)))
+    K.batch_set_value(updates)
+
+
+def sample_initializer(initializer, shape, rng):
+    """initial values of the keras initializers in numpy, so that no ops are added to the
+       graph and a seed gives the same weights every time; other initializers are
+       evaluated in tensorflow"""
+
+    name = type(initializer).__name__
+    if name == 'Zeros':
+        return np.zeros(shape, dtype=np.float32)
+    if name == 'Ones':
+        return np.ones(shape, dtype=np.float32)
+    if name == 'Constant':
+        return np.full(shape, initializer.value, dtype=np.float32)
+    if name == 'RandomNormal':
+        value = rng.normal(initializer.mean, initializer.stddev, shape)
+    elif name == 'RandomUniform':
+        value = rng.uniform(initializer.minval, initializer.maxval, shape)
+    elif name == 'TruncatedNormal':
+        value = initializer.mean + initializer.stddev*truncated_normal(shape, rng)
+    elif isinstance(initializer, keras.initializers.VarianceScaling):
+        # Glorot, He and LeCun initializers
+        receptive_field = int(np.prod(shape[:-2])) if len(shape) > 2 else 1
+        fan_in = shape[-2]*receptive_field if len(shape) > 1 else shape[0]
+        fan_out = shape[-1]*receptive_field
+        fan = {'fan_in': fan_in, 'fan_out': fan_out, 'fan_avg': (fan_in + fan_out)/2.}[initializer.mode]
+        scale = initializer.scale/max(1., fan)
+        if initializer.distribution == 'truncated_normal':
+            # stddev of a standard normal truncated to (-2, 2)
+            value = np.sqrt(scale)/.87962566103423978*truncated_normal(shape, rng)
+        elif initializer.distribution == 'untruncated_normal':
+            value = rng.normal(0., np.sqrt(scale), shape)
+        else:
+            limit = np.sqrt(3.*scale)
+            value = rng.uniform(-limit, limit, shape)
+    else:
+        return K.get_value(initializer(shape))
+    return value.astype(np.float32)
+
+
+def truncated_normal(shape, rng):
+    """standard normal values redrawn until they are within 2 standard deviations"""
+    value = rng.normal(size=shape)
+    outside = np.abs(value) > 2
+    while np.any(outside):
+        value[outside] = rng.normal(size=int(np.sum(outside)))
+        outside = np.abs(value) > 2
+    return value
+
+
+def flatten_layers(model):
+    for layer in model.layers:
+        if hasattr(layer, 'layers'):
+            yield from flatten_layers(layer)
+        else:
+            yield layer
+
+
+def optimizer_variables(optimizer):
+    """iteration count and slots of an optimizer; optimizer.weights is gone from the
+       optimizers of TF >= 2.11, where variables is a property rather than a method"""
+    variables = optimizer.variables
+    return list(variables() if callable(variables) else variables)
+
+
+def build_optimizer(model):
+    """create the slots an optimizer otherwise creates at its first step in eager mode"""
+    optimizer = model.optimizer
+    if hasattr(optimizer, '_create_all_weights'):
+        optimizer._create_all_weights(model.trainable_weights)
+    else:
+        optimizer.build(model.trainable_weights)
+
+
+def set_optimizer_weights(model, weights):
+    build_optimizer(model)
+    variables = optimizer_variables(model.optimizer)
+    if len(variables) != len(weights):
+        raise ValueError('optimizer has %d variables, got %d values'%(len(variables), len(weights)))
+    K.batch_set_value(list(zip(variables, weights)))
+
+
+def reset_optimizer(model, learning_rate):
+    optimizer = model.optimizer
+    K.batch_set_value([(variable, np.zeros(variable.shape, dtype=variable.dtype.as_numpy_dtype))
+                       for variable in optimizer_variables(optimizer)])
+    K.set_value(optimizer.lr, learning_rate)
+
+
+
+#-------------------------------------------------------------------------------------------------
+# Time budget
+#-------------------------------------------------------------------------------------------------
+
+class Budget(keras.callbacks.Callback):
+    """stop training at the end of an epoch when the next one would not finish before the
+       deadline (a time.time() value) or after max_seconds of training. The cost of an
+       epoch is the median time of the epochs after the first warmup ones (which include
+       graph building). stopped_epoch is the last epoch trained, or None; pass the budget
+       to a Checkpoint after it, which then saves a checkpoint to resume from rather than
+       a finished run. Predicted and actual end of training are printed
+       when training ends."""
+
+    def __init__(self, deadline=None, max_seconds=None, warmup=1):
+        super().__init__()
+        self.deadline = deadline
+        self.max_seconds = max_seconds
+        self.warmup = warmup
+        self.epoch_times = []
+        self.start = None
+        self.predicted_end = None
+        self.stopped_epoch = None
+
+
+    @property
+    def limit(self):
+        limits = [self.deadline] if self.deadline else []
+        if self.max_seconds:
+            limits.append(self.start + self.max_seconds)
+        return min(limits) if limits else None
+
+
+    @property
+    def epoch_time(self):
+        """estimated seconds per epoch, or None before the first epoch"""
+        if not self.epoch_times:
+            return None
+        return float(np.median(self.epoch_times[self.warmup:] or self.epoch_times))
+
+
+    def on_train_begin(self, logs=None):
+        # restarts of a diverged run keep counting from the first start
+        if self.start is None:
+            self.start = time.time()
+        self.stopped_epoch = None
+
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.time()
+
+
+    def on_epoch_end(self, epoch, logs=None):
+        now = time.time()
+        self.epoch_times.append(now - self.epoch_start)
+        if self.predicted_end is None and len(self.epoch_times) > self.warmup:
+            self.predicted_end = now + self.epoch_time*(self.params['epochs'] - epoch - 1)
+        if self.model.stop_training or self.limit is None or epoch + 1 >= self.params['epochs']:
+            return
+        if now + self.epoch_time > self.limit:
+            print('time budget: stopping after epoch %d'%(epoch+1))
+            self.model.stop_training = True
+            self.stopped_epoch = epoch
+
+
+    def on_train_end(self, logs=None):
+        if self.predicted_end is not None:
+            print('training ended at %.0f s, predicted %.0f s for all epochs'%(time.time() - self.start,
+                                                                              self.predicted_end - self.start))
+
+
+
+#-------------------------------------------------------------------------------------------------
+# Divergence monitor
+#-------------------------------------------------------------------------------------------------
+
+class TrainingMonitor(keras.callbacks.Callback):
+    """stop a run that diverges. The batch loss is checked after every batch; every
+       interval batches the largest first-layer pre-activation and the gradient norm are
+       computed on a small probe batch (e.g. 100 training sequences). A non-finite value,
+       or one above max_preactivation, max_grad_norm or loss_factor times the best epoch
+       loss, stops training and leaves the event in self.event, with one JSON line per
+       event appended to log_path.
+
+       A Checkpoint given this monitor does not save the epoch a run diverged in, so
+       fit_with_restarts can go back to the last good checkpoint; restarts counts the
+       restarts it made."""
+
+    def __init__(self, probe, name='', log_path=None, interval=10, max_preactivation=None,
+                 max_grad_norm=None, loss_factor=None, layer=None):
+        super().__init__()
+        self.probe = probe
+        self.run_name = name
+        self.log_path = log_path
+        self.interval = interval
+        self.max_preactivation = max_preactivation
+        self.max_grad_norm = max_grad_norm
+        self.loss_factor = loss_factor
+        self.layer = layer
+        self.stats_fn = None
+        self.initial_weights = None
+        self.event = None
+        self.restarts = 0
+
+
+    def on_train_begin(self, logs=None):
+        if self.initial_weights is None:
+            self.initial_weights = self.model.get_weights()
+        if self.stats_fn is None:
+            # models reused by ModelCache keep their stats function
+            stats_fns = STATS_FNS.setdefault(self.model, {})
+            if self.layer not in stats_fns:
+                stats_fns[self.layer] = build_stats_fn(self.model, self.layer)
+            self.stats_fn = stats_fns[self.layer]
+        self.event = None
+        self.best_loss = np.inf
+        self.epoch = 0
+
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+
+    def on_train_batch_end(self, batch, logs=None):
+        loss = (logs or {}).get('loss')
+        if loss is not None:
+            if not np.isfinite(loss):
+                return self.diverge('nonfinite_loss', batch, loss)
+            if self.loss_factor and loss > self.loss_factor*self.best_loss:
+                return self.diverge('exploding_loss', batch, loss)
+
+        if batch%self.interval == 0:
+            preactivation, grad_norm = self.stats_fn(*self.probe)
+            if not np.isfinite(preactivation) or (self.max_preactivation and preactivation > self.max_preactivation):
+                return self.diverge('preactivation', batch, preactivation)
+            if not np.isfinite(grad_norm) or (self.max_grad_norm and grad_norm > self.max_grad_norm):
+                return self.diverge('grad_norm', batch, grad_norm)
+
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.event is None and logs and np.isfinite(logs.get('loss', np.inf)):
+            self.best_loss = min(self.best_loss, logs['loss'])
+
+
+    def diverge(self, reason, batch, value):
+        self.event = {'run': self.run_name, 'event': reason, 'epoch': self.epoch, 'batch': batch,
+                      'value': float(value), 'lr': float(K.get_value(self.model.optimizer.lr)),
+                      'time': time.time()}
+        print('%s diverged at epoch %d, batch %d: %s = %g'%(self.run_name, self.epoch+1, batch, reason, value))
+        self.log(self.event)
+        self.model.stop_training = True
+
+
+    def log(self, event):
+        if self.log_path:
+            os.makedirs(os.path.dirname(self.log_path) or '.', exist_ok=True)
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(event)+'\n')
+
+
+
+STATS_FNS = weakref.WeakKeyDictionary()
+
+
+def preactivation_tensor(model, layer=None):
+    """input of the first Activation layer (the first-layer pre-activation of the
+       model_zoo networks), or of model.layers[layer]"""
+    if layer is not None:
+        return model.layers[layer].input
+    for model_layer in model.layers:
+        if isinstance(model_layer, keras.layers.Activation):
+            return model_layer.input
+    raise ValueError('model has no Activation layer')
+
+
+def build_stats_fn(model, layer=None):
+    """function of a probe batch (x, y) that returns the largest pre-activation and the norm
+       of the loss gradient; a K.function in graph mode, a tf.function in eager mode"""
+
+    loss_fn = keras.losses.get(model.loss)
+    preactivation = preactivation_tensor(model, layer)
+
+    if not tf.executing_eagerly():
+        y_true = K1.placeholder(shape=model.outputs[0].shape)
+        loss = K.mean(loss_fn(y_true, model.outputs[0]))
+        grad_norm = tf.linalg.global_norm(K1.gradients(loss, model.trainable_weights))
+        fn = K1.function([model.inputs[0], y_true], [K.max(preactivation), grad_norm])
+        return lambda x, y: fn([x, y])
+
+    probe_model = keras.Model(inputs=model.inputs, outputs=[preactivation, model.outputs[0]])
+    @tf.function
+    def probe_stats(x, y):
+        with tf.GradientTape() as tape:
+            preactivation, y_pred = probe_model(x, training=False)
+            loss = tf.reduce_mean(loss_fn(y, y_pred))
+        grad_norm = tf.linalg.global_norm(tape.gradient(loss, model.trainable_weights))
+        return tf.reduce_max(preactivation), grad_norm
+    return lambda x, y: [value.numpy() for value in probe_stats(x, y)]
+
+
+
+def fit_with_restarts(model, fit_fn, checkpoint, monitor, max_restarts=0, lr_factor=0.1):
+    """call fit_fn(initial_epoch) and, whenever monitor stops a diverged run, go back to the
+       last good checkpoint (or the initial weights with a fresh optimizer if there is none)
+       with the learning rate scaled by lr_factor, up to max_restarts times (none by
+       default). Each restart is logged as an event and counted in monitor.restarts; a
+       restarted run was trained with another learning rate than the others, so report it
+       apart. Returns the history of the last fit."""
+
+    checkpoint.monitor = monitor
+    for restart in range(max_restarts + 1):
+        history = fit_fn(checkpoint.initial_epoch)
+        if monitor.event is None or restart == max_restarts:
+            return history
+
+        state = checkpoint.load()
+        lr = float(K.get_value(model.optimizer.lr))*lr_factor
+        if state is None:
+            model.set_weights(monitor.initial_weights)
+            reset_optimizer(model, lr)
+        else:
+            lr = state['lr']*lr_factor
+            state['lr'] = lr
+        checkpoint.state = state
+        monitor.restarts = restart + 1
+        monitor.log({'run': monitor.run_name, 'event': 'restart', 'restart': restart+1,
+                     'epoch': checkpoint.initial_epoch, 'lr': lr, 'time': time.time()})
+    return history
+
+
+
+def load_events(path):
+    """all events logged by TrainingMonitor in the .jsonl files under path"""
+    events = []
+    for file_path in sorted(glob.glob(os.path.join(path, '*.jsonl'))):
+        with open(file_path) as f:
+            events += [json.loads(line) for line in f if line.strip()]
+    return events